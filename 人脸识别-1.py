@@ -1,5 +1,6 @@
-import sensor, image, time, tf, json, math
-from pyb import Pin
+import sensor, image, time, tf, json, math, ustruct, micropython, array, uos
+from pyb import Pin, ExtInt, disable_irq, enable_irq
+from ulab import numpy as np
 
 # 按钮引脚定义
 BTN_SELECT = Pin('P0', Pin.IN, Pin.PULL_UP)  # 选择（按下确认当前选项）
@@ -22,9 +23,19 @@ face_cascade_path = "frontalface"  # OpenMV内置人脸检测模型
 face_id_model_path = "face_recognition_model.kmodel"  # 人脸识别模型
 landmark_model_path = "landmark_model.kmodel"  # 人脸关键点模型
 
+# 级联检测参数
+CASCADE_THRESHOLD = 0.75
+CASCADE_SCALE_FACTOR = 1.25
+
 # 初始化模型
 face_cascade = image.HaarCascade(face_cascade_path)
 
+try:
+    eye_cascade = image.HaarCascade("eye")  # 活体检测用，只加载一次
+except Exception as e:
+    eye_cascade = None
+    print(f"人眼检测模型加载失败: {e}")
+
 try:
     face_id_net = tf.load(face_id_model_path)
     print("人脸识别模型加载成功")
@@ -40,58 +51,308 @@ except Exception as e:
     print(f"人脸关键点模型加载失败: {e}")
 
 # 用户数据库路径
-USER_DB_PATH = "user_database.json"
+USER_DB_PATH = "user_database.bin"
+LEGACY_DB_PATH = "user_database.json"  # 旧版JSON数据库，仅用于导入
+
+# 数据库为追加写入的日志：每条记录以操作字节开头
+LOG_ADD = 0x41     # 'A' 后接用户记录
+LOG_DELETE = 0x44  # 'D' 后接ID长度和ID（删除标记）
+
+# 用户记录头: ID长度, 姓名长度, 注册时间长度, 样本数, 特征维数, 量化比例, 范数
+# 记录头之后依次为ID、姓名、注册时间（UTF-8）和int8特征
+RECORD_HEADER = "<BBBBHff"
+RECORD_HEADER_SIZE = ustruct.calcsize(RECORD_HEADER)
+
+# 特征量化为int8，返回(量化特征, 比例)
+def quantize_descriptor(descriptor):
+    scale = max(abs(x) for x in descriptor) / 127
+    if scale == 0:
+        scale = 1.0
+    q = np.array([int(round(x / scale)) for x in descriptor], dtype=np.int8)
+    return q, scale
+
+# 打包单个用户记录
+def pack_user_record(user_id, user_data, descriptor):
+    uid = user_id.encode()
+    name = user_data["name"].encode()
+    reg_time = user_data["registration_time"].encode()
+    header = ustruct.pack(RECORD_HEADER, len(uid), len(name), len(reg_time),
+                          user_data["samples_count"], len(descriptor),
+                          user_data["scale"], user_data["norm"])
+    return header + uid + name + reg_time + ustruct.pack("<%db" % len(descriptor), *descriptor)
+
+# 读取用户记录头及文本字段，返回(用户ID, 用户数据)；特征不读入内存
+def read_user_header(f):
+    header = f.read(RECORD_HEADER_SIZE)
+    if len(header) < RECORD_HEADER_SIZE:
+        raise ValueError("记录不完整")
+    id_len, name_len, time_len, samples_count, dim, scale, norm = \
+        ustruct.unpack(RECORD_HEADER, header)
+    text = f.read(id_len + name_len + time_len)
+    if len(text) < id_len + name_len + time_len:
+        raise ValueError("记录不完整")
+
+    user_data = {
+        "name": text[id_len:id_len+name_len].decode(),
+        "dim": dim,
+        "scale": scale,
+        "norm": norm,
+        "registration_time": text[id_len+name_len:].decode(),
+        "samples_count": samples_count
+    }
+    return text[:id_len].decode(), user_data
+
+# 回放数据库日志，只建立索引（用户ID -> 特征在文件中的偏移）
+# 返回(用户数据, 日志中已失效的记录数, 日志是否在中途损坏)
+def load_user_db():
+    db = {}
+    dead = 0
+    corrupt = False
+    size = uos.stat(USER_DB_PATH)[6]
+    with open(USER_DB_PATH, "rb") as f:
+        offset = 0
+        while offset < size:
+            try:
+                op = f.read(1)[0]
+                if op == LOG_ADD:
+                    user_id, user_data = read_user_header(f)
+                    user_data["offset"] = f.tell()
+                    offset = user_data["offset"] + user_data["dim"]
+                    if offset > size:
+                        raise ValueError("记录不完整")
+                    f.seek(offset)
+                    if user_id in db:
+                        dead += 1
+                    db[user_id] = user_data
+                elif op == LOG_DELETE:
+                    id_len = f.read(1)[0]
+                    user_id = f.read(id_len).decode()
+                    offset = f.tell()
+                    if db.pop(user_id, None) is not None:
+                        dead += 1
+                    dead += 1
+                else:
+                    raise ValueError(f"未知日志操作: {op}")
+            except Exception as e:
+                # 写入中断导致的残缺记录：保留之前已回放的数据
+                print(f"数据库日志在偏移 {offset} 处损坏: {e}")
+                dead += 1
+                corrupt = True
+                break
+    return db, dead, corrupt
+
+# 导入旧版JSON数据库（浮点特征转为int8）
+def load_legacy_user_db():
+    with open(LEGACY_DB_PATH, "r") as f:
+        db = json.load(f)
+    for user_data in db.values():
+        descriptor = user_data["descriptor"]
+        if "norm" not in user_data:
+            user_data["norm"] = math.sqrt(sum(x * x for x in descriptor))
+        user_data["descriptor"], user_data["scale"] = quantize_descriptor(descriptor)
+    return db
+
+# 打开数据库文件用于按需读取特征（文件尚未创建时返回None）
+def open_user_db():
+    try:
+        return open(USER_DB_PATH, "rb")
+    except OSError:
+        return None
+
+# 特征读取缓冲区，所有用户复用
+_descriptor_buf = bytearray(0)
+
+# 读取用户特征：尚未写入文件的用户在内存中，其余按偏移从文件读取
+def read_descriptor(f, user_data):
+    global _descriptor_buf
+    descriptor = user_data.get("descriptor")
+    if descriptor is not None:
+        return descriptor
+    if len(_descriptor_buf) != user_data["dim"]:
+        _descriptor_buf = bytearray(user_data["dim"])
+    f.seek(user_data["offset"])
+    f.readinto(_descriptor_buf)
+    return np.frombuffer(_descriptor_buf, dtype=np.int8)
+
+# 待写入的日志记录；修改只在内存中进行，由 flush_user_db 统一落盘
+_pending_log = []
+_log_dead = 0  # 日志中已失效的记录数，超过有效用户数时压缩
+
+# 记录新增/更新用户
+def log_user_added(user_id):
+    user_data = user_db[user_id]
+    _pending_log.append(bytes([LOG_ADD]) + pack_user_record(user_id, user_data, user_data["descriptor"]))
+
+# 记录删除用户
+def log_user_deleted(user_id):
+    global _log_dead
+    uid = user_id.encode()
+    _pending_log.append(bytes([LOG_DELETE, len(uid)]) + uid)
+    _log_dead += 2  # 删除标记及其对应的新增记录
+
+# 重写数据库文件，只保留有效用户（先写临时文件再替换）
+def compact_user_db():
+    global _log_dead
+    tmp_path = USER_DB_PATH + ".tmp"
+    offsets = {}
+    src = open_user_db()
+    try:
+        with open(tmp_path, "wb") as dst:
+            pos = 0
+            for user_id, user_data in user_db.items():
+                descriptor = read_descriptor(src, user_data)
+                record = bytes([LOG_ADD]) + pack_user_record(user_id, user_data, descriptor)
+                dst.write(record)
+                pos += len(record)
+                offsets[user_id] = pos - len(descriptor)
+    finally:
+        if src:
+            src.close()
+    if src:
+        uos.remove(USER_DB_PATH)
+    uos.rename(tmp_path, USER_DB_PATH)
+
+    # 所有特征都已在文件中，释放内存中的副本
+    for user_id, user_data in user_db.items():
+        descriptor = user_data.pop("descriptor", None)
+        if descriptor is not None:
+            user_data["dim"] = len(descriptor)
+        user_data["offset"] = offsets[user_id]
+    _pending_log.clear()
+    _log_dead = 0
+
+# 将内存中的修改写入文件（只追加变化部分）
+def flush_user_db():
+    if not _pending_log:
+        return
+    try:
+        if _log_dead > len(user_db):
+            compact_user_db()
+        else:
+            with open(USER_DB_PATH, "ab") as f:
+                for record in _pending_log:
+                    f.write(record)
+            _pending_log.clear()
+    except Exception as e:
+        print(f"保存用户数据失败: {e}")
 
 # 加载已有用户数据
 try:
-    with open(USER_DB_PATH, "r") as f:
-        user_db = json.load(f)
+    user_db, _log_dead, _log_corrupt = load_user_db()
     print(f"已加载 {len(user_db)} 个用户数据")
+    if _log_corrupt:
+        # 损坏处之后不能再追加记录，否则下次回放同样会在此处停止，新记录全部丢失
+        try:
+            compact_user_db()
+        except Exception as e:
+            print(f"重写用户数据库失败: {e}")
+            _log_dead = len(user_db) + 1  # 下次保存时改为重写，不在损坏处之后追加
 except Exception as e:
-    user_db = {}
-    print(f"用户数据库加载失败: {e}")
-    print("将创建新的用户数据库")
-
-# 按钮检测函数（消抖）
+    try:
+        user_db = load_legacy_user_db()
+        for user_id in user_db:
+            log_user_added(user_id)
+        print(f"已从旧版数据库导入 {len(user_db)} 个用户数据")
+    except Exception:
+        user_db = {}
+        print(f"用户数据库加载失败: {e}")
+        print("将创建新的用户数据库")
+
+# 按钮中断：下降沿锁存按下事件，读取时清除，主循环无需等待消抖
+micropython.alloc_emergency_exception_buf(100)
+
+BUTTONS = (BTN_SELECT, BTN_UP, BTN_DOWN, BTN_BACK)
+DEBOUNCE_MS = 20  # 消抖时间窗口
+
+_btn_flags = bytearray(len(BUTTONS))
+_btn_last_ms = [0] * len(BUTTONS)
+
+# 中断回调（不可分配内存）
+def _latch(index):
+    now = time.ticks_ms()
+    if time.ticks_diff(now, _btn_last_ms[index]) > DEBOUNCE_MS and BUTTONS[index].value() == 0:
+        _btn_flags[index] = 1
+    _btn_last_ms[index] = now
+
+_btn_irqs = [ExtInt(pin, ExtInt.IRQ_FALLING, Pin.PULL_UP, lambda line, i=i: _latch(i))
+             for i, pin in enumerate(BUTTONS)]
+
+# 按钮检测函数（读取并清除锁存标志）
 def is_button_pressed(button):
-    if button.value() == 0:  # 低电平表示按下
-        time.sleep_ms(20)    # 消抖
-        if button.value() == 0:
-            # 等待释放
-            while button.value() == 0:
-                time.sleep_ms(10)
-            return True
-    return False
-
-# 等待任意按钮按下
-def wait_for_any_button():
+    index = BUTTONS.index(button)
+    state = disable_irq()
+    pressed = _btn_flags[index]
+    _btn_flags[index] = 0
+    enable_irq(state)
+    return pressed == 1
+
+CHORD_HOLD_MS = 300  # 组合键需同时按住的时间
+
+_chord_start = None
+_chord_fired = False
+
+# 多个按钮同时按住（按引脚电平判断，不依赖各自的锁存；松开后才能再次触发）
+def are_buttons_held(*buttons):
+    global _chord_start, _chord_fired
+    if not all(button.value() == 0 for button in buttons):
+        _chord_start = None
+        _chord_fired = False
+        return False
+    if _chord_fired:
+        return False
+    now = time.ticks_ms()
+    if _chord_start is None:
+        _chord_start = now
+    if time.ticks_diff(now, _chord_start) < CHORD_HOLD_MS:
+        return False
+    _chord_fired = True
+    clear_buttons()  # 丢弃组合键按下时锁存的单键事件
+    return True
+
+# 清除所有未读取的按下事件（进入新界面时丢弃之前的按键）
+def clear_buttons():
+    state = disable_irq()
+    for i in range(len(_btn_flags)):
+        _btn_flags[i] = 0
+    enable_irq(state)
+
+# 菜单轮询间隔（按钮由中断锁存，界面只在状态变化时重绘）
+MENU_POLL_MS = 20
+
+# 等待指定按钮之一按下（丢弃进入前的按键），返回按下的按钮
+def wait_for_button(*buttons):
+    clear_buttons()
     while True:
-        if is_button_pressed(BTN_UP) or is_button_pressed(BTN_DOWN) or \
-           is_button_pressed(BTN_SELECT) or is_button_pressed(BTN_BACK):
-            break
-        time.sleep_ms(50)
+        for button in buttons:
+            if is_button_pressed(button):
+                return button
+        time.sleep_ms(MENU_POLL_MS)
 
 # 按钮菜单选择器
 def button_menu(title, options, allow_back=True):
     selected = 0
+    last_selected = None
+    clear_buttons()
 
     while True:
-        # 清屏
-        print("\033c")
-        print("="*30)
-        print(title)
-        print("="*30)
-
-        # 显示选项列表
-        for i, option in enumerate(options):
-            prefix = "→ " if i == selected else "   "
-            print(f"{prefix}{option}")
-
-        print("="*30)
-        if allow_back:
-            print("上/下: 选择 | 选择: 确认 | 返回: 后退")
-        else:
-            print("上/下: 选择 | 选择: 确认")
+        if selected != last_selected:
+            # 清屏
+            print("\033c")
+            print("="*30)
+            print(title)
+            print("="*30)
+
+            # 显示选项列表
+            for i, option in enumerate(options):
+                prefix = "→ " if i == selected else "   "
+                print(f"{prefix}{option}")
+
+            print("="*30)
+            if allow_back:
+                print("上/下: 选择 | 选择: 确认 | 返回: 后退")
+            else:
+                print("上/下: 选择 | 选择: 确认")
+            last_selected = selected
 
         # 检测按钮
         if is_button_pressed(BTN_UP):
@@ -103,7 +364,7 @@ def button_menu(title, options, allow_back=True):
         elif allow_back and is_button_pressed(BTN_BACK):
             return -1
 
-        time.sleep_ms(100)  # 降低CPU使用率
+        time.sleep_ms(MENU_POLL_MS)  # 降低CPU使用率
 
 # 中文输入界面
 def chinese_input(title, max_length=8):
@@ -122,32 +383,44 @@ def chinese_input(title, max_length=8):
     current_text = ""
     page = 0
     selected = 0
+    last_state = None
+    clear_buttons()
 
     while True:
-        print("\033c")
-        print("="*30)
-        print(title)
-        print("="*30)
-        print(f"当前输入: {current_text}")
-        print("-"*30)
-
-        # 显示当前页的汉字
-        if page < len(chinese_chars):
-            chars = chinese_chars[page]
-            for i in range(0, len(chars), 4):
-                line = ""
-                for j in range(4):
-                    if i+j < len(chars):
-                        prefix = "[" if i+j == selected else " "
-                        suffix = "]" if i+j == selected else " "
-                        line += f"{prefix}{chars[i+j]}{suffix} "
-                print(line)
-
-        print("-"*30)
-        print("上/下: 选择 | 选择: 添加 | 返回: 删除 | 下页: 确认")
-
-        # 检测按钮
-        if is_button_pressed(BTN_UP):
+        state = (page, selected, current_text)
+        if state != last_state:
+            print("\033c")
+            print("="*30)
+            print(title)
+            print("="*30)
+            print(f"当前输入: {current_text}")
+            print("-"*30)
+
+            # 显示当前页的汉字
+            if page < len(chinese_chars):
+                chars = chinese_chars[page]
+                for i in range(0, len(chars), 4):
+                    line = ""
+                    for j in range(4):
+                        if i+j < len(chars):
+                            prefix = "[" if i+j == selected else " "
+                            suffix = "]" if i+j == selected else " "
+                            line += f"{prefix}{chars[i+j]}{suffix} "
+                    print(line)
+
+            print("-"*30)
+            print("上/下: 选择 | 选择: 添加 | 返回: 删除 | 下页: 确认")
+            last_state = state
+
+        # 检测按钮（组合键按电平判断，先于单键处理）
+        if are_buttons_held(BTN_UP, BTN_DOWN):  # 同时按住上和下退出
+            if current_text:
+                return current_text
+            else:
+                print("姓名不能为空！")
+                time.sleep_ms(1000)
+                last_state = None  # 提示后重绘
+        elif is_button_pressed(BTN_UP):
             selected = (selected - 1) % len(chinese_chars[page])
         elif is_button_pressed(BTN_DOWN):
             selected = (selected + 1) % len(chinese_chars[page])
@@ -159,45 +432,39 @@ def chinese_input(title, max_length=8):
                 current_text = current_text[:-1]
             else:
                 return ""  # 返回空表示取消
-        elif is_button_pressed(BTN_UP) and is_button_pressed(BTN_DOWN):  # 同时按下上和下退出
-            if current_text:
-                return current_text
-            else:
-                print("姓名不能为空！")
-                time.sleep_ms(1000)
 
-        time.sleep_ms(100)
-
-# 人脸对齐函数
-def align_face(img, face_rect):
-    if landmark_net is None:
-        return img.copy(roi=face_rect)
+        time.sleep_ms(MENU_POLL_MS)
 
-    # 检测人脸关键点
-    face_roi = img.copy(roi=face_rect)
-    landmarks = landmark_net.classify(face_roi)[0].output()
+RAD2DEG = 180.0 / math.pi
 
-    # 提取左右眼和嘴的关键点
-    left_eye = (landmarks[0] * face_rect[2] + face_rect[0],
-                landmarks[1] * face_rect[3] + face_rect[1])
-    right_eye = (landmarks[2] * face_rect[2] + face_rect[0],
-                 landmarks[3] * face_rect[3] + face_rect[1])
+# 根据左右眼关键点计算旋转角度（关键点为人脸区域内的相对坐标）
+# 旋转后缩放到96x96，精确到整数度即可
+@micropython.native
+def eye_angle(landmarks, w, h):
+    dx = (landmarks[2] - landmarks[0]) * w
+    dy = (landmarks[3] - landmarks[1]) * h
+    return int(math.atan2(dy, dx) * RAD2DEG)
 
-    # 计算旋转角度
-    dx = right_eye[0] - left_eye[0]
-    dy = right_eye[1] - left_eye[1]
-    angle = math.atan2(dy, dx) * 180 / math.pi
+# 当前帧的人脸关键点缓存（以人脸矩形为键），每帧开始时清空
+_landmark_cache = {}
 
-    # 旋转图像使眼睛水平
-    img_aligned = img.copy()
-    img_aligned.rotate(angle)
+# 人脸对齐函数
+def align_face(img, face_rect):
+    # 先裁剪人脸区域，后续只处理小图
+    face_roi = img.copy(roi=face_rect)
+    if landmark_net is None:
+        return face_roi
 
-    # 重新计算对齐后的人脸区域
-    cx, cy = (face_rect[0] + face_rect[2]//2, face_rect[1] + face_rect[3]//2)
-    w, h = face_rect[2], face_rect[3]
-    new_rect = (cx - w//2, cy - h//2, w, h)
+    # 检测人脸关键点（同一帧内同一人脸只运行一次模型）
+    landmarks = _landmark_cache.get(face_rect)
+    if landmarks is None:
+        landmarks = landmark_net.classify(face_roi)[0].output()
+        _landmark_cache[face_rect] = landmarks
+    angle = eye_angle(landmarks, face_rect[2], face_rect[3])
 
-    return img_aligned.copy(roi=new_rect)
+    # 只旋转人脸区域使眼睛水平
+    face_roi.rotate(angle)
+    return face_roi
 
 # 人脸特征提取函数
 def extract_face_descriptor(img, rect):
@@ -217,47 +484,122 @@ def extract_face_descriptor(img, rect):
     features = face_id_net.classify(face_roi, min_scale=1.0, scale_mul=0.8, x_overlap=0.5, y_overlap=0.5)[0].output()
     return features
 
-# 计算余弦相似度
-def cosine_similarity(feat1, feat2):
-    dot_product = sum(a * b for a, b in zip(feat1, feat2))
-    norm_a = sum(a * a for a in feat1) ** 0.5
-    norm_b = sum(b * b for b in feat2) ** 0.5
-    if norm_a == 0 or norm_b == 0:
-        return 0
-    return dot_product / (norm_a * norm_b)
+# 所有用户特征堆叠成的矩阵，识别时一次矩阵-向量乘法得到全部相似度
+_db_ids = []         # 矩阵各行对应的用户ID
+_db_matrix = None    # (用户数, 特征维数) int8矩阵，None表示需要重建
+_db_factors = None   # 每行的 量化比例/范数，用于还原余弦相似度
+
+# 用户增删后矩阵失效，下次识别时重建
+def invalidate_db_matrix():
+    global _db_matrix
+    _db_matrix = None
+
+# 从数据库重建特征矩阵
+def build_db_matrix():
+    global _db_ids, _db_matrix, _db_factors
+    _db_ids = list(user_db.keys())
+    factors = []
+    f = open_user_db()
+    try:
+        for i, user_id in enumerate(_db_ids):
+            user_data = user_db[user_id]
+            descriptor = read_descriptor(f, user_data)
+            if _db_matrix is None:
+                _db_matrix = np.zeros((len(_db_ids), len(descriptor)), dtype=np.int8)
+            _db_matrix[i, :] = descriptor
+            norm = user_data["norm"]
+            factors.append(user_data["scale"] / norm if norm else 0.0)
+    finally:
+        if f:
+            f.close()
+    _db_factors = np.array(factors, dtype=np.float)
 
 # 人脸比对函数
 def recognize_face(descriptor, threshold=0.5):
-    if descriptor is None:
+    if descriptor is None or not user_db:
         return None
 
-    best_match_id = None
-    highest_similarity = threshold  # 低于阈值则认为是未知人脸
-
-    for user_id, user_data in user_db.items():
-        known_descriptor = user_data["descriptor"]
-        similarity = cosine_similarity(descriptor, known_descriptor)
-
-        if similarity > highest_similarity:
-            highest_similarity = similarity
-            best_match_id = user_id
-
-    return best_match_id
+    # 查询特征每帧只量化一次
+    norm = math.sqrt(sum(x * x for x in descriptor))
+    if norm == 0:
+        return None
+    descriptor, scale = quantize_descriptor(descriptor)
+
+    if _db_matrix is None:
+        build_db_matrix()
+
+    # 余弦相似度 = int8点积 * (比例_查询/范数_查询) * (比例_用户/范数_用户)
+    similarities = np.dot(_db_matrix, descriptor).flatten() * _db_factors * (scale / norm)
+    best = int(np.argmax(similarities))
+    if similarities[best] > threshold:  # 低于阈值则认为是未知人脸
+        return _db_ids[best]
+    return None
+
+# 每帧处理时间预算（约15FPS），处理更快时才让出剩余时间
+FRAME_BUDGET_MS = 66
+
+# 按帧预算等待剩余时间
+def wait_frame_budget(frame_start):
+    elapsed = time.ticks_diff(time.ticks_ms(), frame_start)
+    if elapsed < FRAME_BUDGET_MS:
+        time.sleep_ms(FRAME_BUDGET_MS - elapsed)
+
+# 空画面判断：中心区域亮度标准差低于阈值时画面过于均匀，不可能有人脸
+SCENE_ROI = (80, 60, 160, 120)  # QVGA中心区域
+MIN_SCENE_STDEV = 10
+
+def scene_has_detail(img):
+    return img.get_statistics(roi=SCENE_ROI).l_stdev() >= MIN_SCENE_STDEV
+
+# 每隔多少帧做一次全图人脸检测（其余帧只在上一帧人脸附近搜索）
+FULL_SEARCH_INTERVAL = 10
+
+# 人脸检测：有上一帧人脸时只搜索其周围2倍区域，未找到或定期回退全图
+def find_faces(img, prev_face, frame_count):
+    if prev_face and frame_count % FULL_SEARCH_INTERVAL:
+        x, y, w, h = prev_face
+        rx = max(0, x - w//2)
+        ry = max(0, y - h//2)
+        search_roi = (rx, ry, min(2*w, img.width() - rx), min(2*h, img.height() - ry))
+        faces = img.find_features(face_cascade, threshold=CASCADE_THRESHOLD,
+                                  scale_factor=CASCADE_SCALE_FACTOR, roi=search_roi)
+        if faces:
+            return faces
+    return img.find_features(face_cascade, threshold=CASCADE_THRESHOLD, scale_factor=CASCADE_SCALE_FACTOR)
+
+# 人脸位置基本不变时复用上次识别结果：交并比阈值和最多复用帧数
+CNN_REUSE_IOU = 0.6
+CNN_REUSE_FRAMES = 5
+
+# 两个矩形的交并比
+def rect_iou(a, b):
+    x1 = max(a[0], b[0])
+    y1 = max(a[1], b[1])
+    x2 = min(a[0] + a[2], b[0] + b[2])
+    y2 = min(a[1] + a[3], b[1] + b[3])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union else 0
 
 # 简单的活体检测（眨眼检测）
 def liveness_detection(img, face_rect, timeout_ms=5000):
+    if eye_cascade is None:
+        return False
+
     start_time = time.ticks_ms()
     eyes_detected = False
     eyes_closed = False
+    clear_buttons()
 
     while time.ticks_diff(time.ticks_ms(), start_time) < timeout_ms:
         img = sensor.snapshot()
-        faces = img.find_features(face_cascade, threshold=0.75, scale_factor=1.25)
+        faces = img.find_features(face_cascade, threshold=CASCADE_THRESHOLD, scale_factor=CASCADE_SCALE_FACTOR)
 
         if faces:
             face = faces[0]
             # 简化的眨眼检测：检测到眼睛然后眼睛消失表示眨眼
-            eyes = img.find_features(image.HaarCascade("eye"), threshold=0.75, scale_factor=1.25, roi=face)
+            eyes = img.find_features(eye_cascade, threshold=CASCADE_THRESHOLD,
+                                     scale_factor=CASCADE_SCALE_FACTOR, roi=face)
 
             if eyes and not eyes_detected:
                 eyes_detected = True
@@ -272,6 +614,19 @@ def liveness_detection(img, face_rect, timeout_ms=5000):
 
     return eyes_detected and eyes_closed
 
+# 多个样本特征取平均（逐样本累加，每个样本只遍历一次）
+@micropython.native
+def average_descriptor(samples):
+    dim = len(samples[0])
+    avg = array.array('f', [0.0] * dim)
+    for sample in samples:
+        for i in range(dim):
+            avg[i] += sample[i]
+    inv = 1.0 / len(samples)
+    for i in range(dim):
+        avg[i] *= inv
+    return avg
+
 # 人脸注册模式
 def registration_mode():
     print("进入人脸注册模式")
@@ -286,16 +641,22 @@ def registration_mode():
     print("请将人脸对准摄像头")
     print("按上键拍照，按选择键完成注册")
 
+    clear_buttons()  # 丢弃输入姓名时残留的按键，避免误拍照
     samples = []
+    prev_face = None
+    frame_count = 0
     while len(samples) < 5:  # 采集5张样本
+        frame_start = time.ticks_ms()
+        _landmark_cache.clear()
         img = sensor.snapshot()
-        faces = img.find_features(face_cascade, threshold=0.75, scale_factor=1.25)
+        faces = find_faces(img, prev_face, frame_count) if scene_has_detail(img) else None
+        frame_count += 1
+        prev_face = faces[0] if faces else None
 
         if faces:
             face = faces[0]
-            img.draw_rectangle(face)
-            img.draw_string(face[0], face[1]-10, f"样本 {len(samples)+1}/5")
 
+            # 特征提取直接使用原始画面，叠加信息在提取之后再绘制
             if is_button_pressed(BTN_UP):
                 # 简单的质量检测
                 if face[2] < 80 or face[3] < 80:  # 人脸太小
@@ -305,15 +666,20 @@ def registration_mode():
 
                 descriptor = extract_face_descriptor(img, face)
                 if descriptor:
-                    samples.append(descriptor)
+                    samples.append(array.array('f', descriptor))
                     print(f"已拍摄样本 {len(samples)}/5")
                 else:
                     print("未提取到有效特征，请调整角度")
                     time.sleep_ms(1000)
 
+            img.draw_rectangle(face)
+            img.draw_string(face[0], face[1]-10, f"样本 {len(samples)+1}/5")
+
         if is_button_pressed(BTN_SELECT) and samples:
             break
 
+        wait_frame_budget(frame_start)
+
     if not samples:
         print("注册失败：未采集到有效样本")
         return False
@@ -325,7 +691,9 @@ def registration_mode():
         return False
 
     # 取平均特征作为注册特征
-    avg_descriptor = [sum(features[i] for features in samples) / len(samples) for i in range(len(samples[0]))]
+    avg_descriptor = average_descriptor(samples)
+    norm = math.sqrt(sum(x * x for x in avg_descriptor))
+    q_descriptor, scale = quantize_descriptor(avg_descriptor)
 
     # 生成唯一用户ID
     user_id = str(time.ticks_ms())  # 使用时间戳作为ID
@@ -333,51 +701,39 @@ def registration_mode():
     # 保存到数据库
     user_db[user_id] = {
         "name": name,
-        "descriptor": avg_descriptor,
+        "descriptor": q_descriptor,
+        "scale": scale,
+        "norm": norm,
         "registration_time": str(time.localtime()),
         "samples_count": len(samples)
     }
 
-    # 保存到文件
-    try:
-        with open(USER_DB_PATH, "w") as f:
-            json.dump(user_db, f)
-        print(f"成功注册用户: {name}")
-        return True
-    except Exception as e:
-        print(f"保存用户数据失败: {e}")
-        # 从内存中删除用户
-        if user_id in user_db:
-            del user_db[user_id]
-        return False
+    # 记录到日志，返回主菜单时写入文件
+    log_user_added(user_id)
+    invalidate_db_matrix()
+    print(f"成功注册用户: {name}")
+    return True
 
 # 用户管理
 def manage_users():
     while True:
-        print("\033c")
-        print("="*30)
-        print("用户管理")
-        print("="*30)
-
+        clear_buttons()
         if not user_db:
+            print("\033c")
+            print("="*30)
+            print("用户管理")
+            print("="*30)
             print("暂无注册用户")
             print("="*30)
             print("按选择键返回")
-            while not is_button_pressed(BTN_SELECT):
-                time.sleep_ms(100)
+            wait_for_button(BTN_SELECT)
             return
 
-        # 显示用户列表
         user_list = list(user_db.items())
-        for idx, (user_id, user_data) in enumerate(user_list, 1):
-            print(f"{idx}. {user_data['name']} ({user_id})")
-
-        print(f"{len(user_list)+1}. 返回")
-        print("="*30)
-        print("上/下: 选择 | 选择: 查看详情 | 返回: 删除用户")
 
         # 选择用户
         selected = 0
+        last_selected = None
         while True:
             if is_button_pressed(BTN_UP):
                 selected = (selected - 1) % (len(user_list) + 1)
@@ -396,20 +752,22 @@ def manage_users():
                     delete_user(user_list[selected][0])
                 break
 
-            # 更新显示
-            print("\033c")
-            print("="*30)
-            print("用户管理")
-            print("="*30)
-            for idx, (user_id, user_data) in enumerate(user_list, 1):
-                prefix = "→ " if idx-1 == selected else "   "
-                print(f"{prefix}{idx}. {user_data['name']} ({user_id})")
-            prefix = "→ " if selected == len(user_list) else "   "
-            print(f"{prefix}{len(user_list)+1}. 返回")
-            print("="*30)
-            print("上/下: 选择 | 选择: 查看详情 | 返回: 删除用户")
-
-            time.sleep_ms(100)
+            # 选择变化时才更新显示
+            if selected != last_selected:
+                print("\033c")
+                print("="*30)
+                print("用户管理")
+                print("="*30)
+                for idx, (user_id, user_data) in enumerate(user_list, 1):
+                    prefix = "→ " if idx-1 == selected else "   "
+                    print(f"{prefix}{idx}. {user_data['name']} ({user_id})")
+                prefix = "→ " if selected == len(user_list) else "   "
+                print(f"{prefix}{len(user_list)+1}. 返回")
+                print("="*30)
+                print("上/下: 选择 | 选择: 查看详情 | 返回: 删除用户")
+                last_selected = selected
+
+            time.sleep_ms(MENU_POLL_MS)
 
 # 查看用户详情
 def view_user_details(user_id):
@@ -429,8 +787,7 @@ def view_user_details(user_id):
     print("="*30)
     print("按选择键返回")
 
-    while not is_button_pressed(BTN_SELECT):
-        time.sleep_ms(100)
+    wait_for_button(BTN_SELECT)
 
 # 删除用户
 def delete_user(user_id):
@@ -446,23 +803,15 @@ def delete_user(user_id):
     print("="*30)
     print("上: 确认 | 返回: 取消")
 
-    while True:
-        if is_button_pressed(BTN_UP):
-            # 删除用户
-            del user_db[user_id]
-            try:
-                with open(USER_DB_PATH, "w") as f:
-                    json.dump(user_db, f)
-                print(f"已删除用户: {user_data['name']}")
-            except Exception as e:
-                print(f"删除用户失败: {e}")
-            time.sleep_ms(1000)
-            break
-        elif is_button_pressed(BTN_BACK):
-            print("已取消删除")
-            time.sleep_ms(1000)
-            break
-        time.sleep_ms(100)
+    if wait_for_button(BTN_UP, BTN_BACK) == BTN_UP:
+        # 删除用户
+        del user_db[user_id]
+        log_user_deleted(user_id)
+        invalidate_db_matrix()
+        print(f"已删除用户: {user_data['name']}")
+    else:
+        print("已取消删除")
+    time.sleep_ms(1000)
 
 # 主菜单
 def main_menu():
@@ -481,16 +830,39 @@ def main():
             print("开始人脸识别，按选择键退出")
             print("="*30)
 
+            prev_face = None
+            frame_count = 0
+            skipped_frames = 0  # 空画面跳过计数，用于调整阈值
+            last_cnn_frame = 0
+            last_cnn_face = None  # 上次运行识别模型时的人脸位置
+            last_face_id = None
+            clear_buttons()
             while(True):
+                frame_start = time.ticks_ms()
+                _landmark_cache.clear()
                 img = sensor.snapshot()
-                faces = img.find_features(face_cascade, threshold=0.75, scale_factor=1.25)
+                if scene_has_detail(img):
+                    faces = find_faces(img, prev_face, frame_count)
+                else:
+                    faces = None
+                    skipped_frames += 1
+                frame_count += 1
+                prev_face = faces[0] if faces else None
 
                 if faces:
                     face = faces[0]
-                    img.draw_rectangle(face)
 
-                    descriptor = extract_face_descriptor(img, face)
-                    face_id = recognize_face(descriptor)
+                    # 同一张脸在短时间内身份不变，跳过识别模型
+                    if last_cnn_face and frame_count - last_cnn_frame < CNN_REUSE_FRAMES and \
+                       rect_iou(face, last_cnn_face) > CNN_REUSE_IOU:
+                        face_id = last_face_id
+                    else:
+                        descriptor = extract_face_descriptor(img, face)
+                        face_id = recognize_face(descriptor)
+                        last_cnn_frame = frame_count
+                        last_cnn_face = face
+                        last_face_id = face_id
+                    img.draw_rectangle(face)  # 提取特征后再绘制，避免边框进入人脸区域
 
                     if face_id:
                         user_data = user_db.get(face_id)
@@ -502,11 +874,10 @@ def main():
                         print("识别结果: 未知人脸")
 
                 if is_button_pressed(BTN_SELECT):
-                    print("已退出识别模式")
-                    time.sleep_ms(500)
+                    print(f"已退出识别模式（跳过空画面 {skipped_frames}/{frame_count} 帧）")
                     break
 
-                time.sleep_ms(100)
+                wait_frame_budget(frame_start)
 
         elif choice == 1:  # 注册新人脸
             registration_mode()
@@ -515,8 +886,12 @@ def main():
             manage_users()
 
         elif choice == 3:  # 退出
+            flush_user_db()
             print("系统已关闭")
             break
 
+        # 从菜单返回后统一保存修改
+        flush_user_db()
+
 if __name__ == "__main__":
     main()
@@ -1,18 +1,44 @@
-import sensor, image, time, tf, json, math
+import sensor, image, time, tf, json, math, micropython, array, ubinascii, uos
 from pyb import Pin
 
+try:
+    from ulab import numpy as np
+except ImportError:
+    np = None
+    print("未找到ulab，相似度使用纯Python计算")
+
 # 按钮引脚定义
 BTN_SELECT = Pin('P0', Pin.IN, Pin.PULL_UP)  # 选择（按下确认当前选项）
 BTN_UP = Pin('P1', Pin.IN, Pin.PULL_UP)      # 上/确认（注册时拍照）
 BTN_DOWN = Pin('P2', Pin.IN, Pin.PULL_UP)    # 下
 BTN_BACK = Pin('P3', Pin.IN, Pin.PULL_UP)    # 返回/删除
 
+# 按键中断：任一按键按下时置位，菜单循环据此提前结束等待
+_btn_event = bytearray(1)
+
+def _on_button(pin):
+    _btn_event[0] = 1
+
+_BUTTONS = (BTN_SELECT, BTN_UP, BTN_DOWN, BTN_BACK)
+
+for _pin in _BUTTONS:
+    _pin.irq(handler=_on_button, trigger=Pin.IRQ_FALLING)
+
 # 系统配置
 class SystemConfig:
-    DB_PATH = "user_database.json"
+    DB_PATH = "user_database.json"     # 旧版整体JSON数据库，仅用于导入
+    META_PATH = "user_meta.jsonl"
+    DESCRIPTOR_PATH = "users.bin"
     FACE_MODEL = "face_recognition_model.kmodel"
     LANDMARK_MODEL = "landmark_model.kmodel"
     CASCADE_MODEL = "frontalface"
+    CASCADE_STAGES = 16  # 截断级联级数换速度，frontalface共25级
+    DETECT_SCALE = 2     # 检测前缩小倍数，扫描面积减为1/4
+    MOTION_THRESHOLD = 6  # 缩略图平均灰度差超过该值才重新检测
+    DETECT_INTERVAL = 5   # 画面静止时每隔N帧仍强制检测一次
+    LIVENESS_REDETECT = 4  # 活体检测中每隔N帧重新检测人脸位置，其余帧沿用上次的人脸框
+    DOT_UNROLL_MAX_DIM = 64  # 特征维数不超过该值时生成完全展开的点积函数
+    EYE_CASCADE_MODEL = "eye"
     MIN_FACE_SIZE = 80
     REGISTRATION_SAMPLES = 5
     SIMILARITY_THRESHOLD = 0.5
@@ -30,7 +56,16 @@ def init_camera():
 
 # 初始化模型
 def init_models():
-    face_cascade = image.HaarCascade(SystemConfig.CASCADE_MODEL)
+    try:
+        face_cascade = image.HaarCascade(SystemConfig.CASCADE_MODEL, stages=SystemConfig.CASCADE_STAGES)
+    except Exception as e:
+        print(f"截断级联加载失败，使用完整级联: {e}")
+        face_cascade = image.HaarCascade(SystemConfig.CASCADE_MODEL)
+    try:
+        eye_cascade = image.HaarCascade(SystemConfig.EYE_CASCADE_MODEL)  # 活体检测用，只加载一次
+    except Exception as e:
+        eye_cascade = None
+        print(f"人眼检测模型加载失败: {e}")
 
     face_id_net = None
     try:
@@ -46,20 +81,71 @@ def init_models():
     except Exception as e:
         print(f"人脸关键点模型加载失败: {e}")
 
-    return face_cascade, face_id_net, landmark_net
+    return face_cascade, eye_cascade, face_id_net, landmark_net
+
+# 按钮消抖检测（不阻塞）：每次只读一次引脚，每次按下只报告一次，松开时记录时间用于消抖
+DEBOUNCE_MS = 20
+_btn_held = bytearray(len(_BUTTONS))
+_btn_up_ms = [0] * len(_BUTTONS)
+
+def _btn_pressed(button):
+    i = _BUTTONS.index(button)
+    now = time.ticks_ms()
+    if button.value() == 0:  # 低电平表示按下
+        if _btn_held[i]:
+            return False
+        _btn_held[i] = 1
+        # 松开后DEBOUNCE_MS内再次读到低电平视为抖动，不算新的按下
+        if time.ticks_diff(now, _btn_up_ms[i]) < DEBOUNCE_MS:
+            return False
+        _btn_event[0] = 0  # 本次按下已处理，下次wait_event不因它立即返回
+        return True
+    if _btn_held[i]:
+        _btn_held[i] = 0
+        _btn_up_ms[i] = now
+    return False
 
 # 按钮操作类
 class ButtonHandler:
+    # snapshot() 返回的按键位掩码
+    SELECT = 0x01
+    UP = 0x02
+    DOWN = 0x04
+    BACK = 0x08
+
     @staticmethod
     def is_pressed(button):
-        if button.value() == 0:  # 低电平表示按下
-            time.sleep_ms(20)    # 消抖
-            if button.value() == 0:
-                # 等待释放
-                while button.value() == 0:
-                    time.sleep_ms(10)
-                return True
-        return False
+        return _btn_pressed(button)
+
+    @staticmethod
+    def _read_mask():
+        mask = 0
+        if BTN_SELECT.value() == 0:
+            mask |= ButtonHandler.SELECT
+        if BTN_UP.value() == 0:
+            mask |= ButtonHandler.UP
+        if BTN_DOWN.value() == 0:
+            mask |= ButtonHandler.DOWN
+        if BTN_BACK.value() == 0:
+            mask |= ButtonHandler.BACK
+        return mask
+
+    # 一次读取全部按键，整体只消抖一次；按住期间累计掩码，松开后返回，可识别组合键
+    @staticmethod
+    def snapshot():
+        mask = ButtonHandler._read_mask()
+        if not mask:
+            return 0
+        time.sleep_ms(20)  # 消抖
+        mask &= ButtonHandler._read_mask()
+        if mask:
+            current = mask
+            while current:
+                mask |= current
+                time.sleep_ms(10)
+                current = ButtonHandler._read_mask()
+            _btn_event[0] = 0  # 按下与松开期间的中断均已处理
+        return mask
 
     @staticmethod
     def wait_for_any():
@@ -67,7 +153,15 @@ class ButtonHandler:
             if ButtonHandler.is_pressed(BTN_UP) or ButtonHandler.is_pressed(BTN_DOWN) or \
                ButtonHandler.is_pressed(BTN_SELECT) or ButtonHandler.is_pressed(BTN_BACK):
                 break
-            time.sleep_ms(50)
+            ButtonHandler.wait_event(50)
+
+    # 等待按键中断或超时，代替菜单循环中的固定延时
+    @staticmethod
+    def wait_event(timeout_ms):
+        start = time.ticks_ms()
+        while not _btn_event[0] and time.ticks_diff(time.ticks_ms(), start) < timeout_ms:
+            time.sleep_ms(5)
+        _btn_event[0] = 0
 
 # 菜单系统
 class MenuSystem:
@@ -102,21 +196,52 @@ class MenuSystem:
             elif allow_back and ButtonHandler.is_pressed(BTN_BACK):
                 return -1
 
-            time.sleep_ms(100)  # 降低CPU使用率
+            ButtonHandler.wait_event(100)  # 降低CPU使用率，有按键时立即响应
 
     @staticmethod
     def _clear_screen():
         print("\033c")
 
+# L2归一化：单位向量之间的余弦相似度就是点积
+def _l2_normalize(v):
+    if np is not None:
+        v = np.array(v, dtype=np.float)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    norm = math.sqrt(sum(a * a for a in v))
+    return [a / norm for a in v] if norm else list(v)
+
+# 多个样本特征按列求平均（结果在UserDatabase.add中归一化）
+def _mean_descriptor(samples):
+    if np is not None:
+        m = np.zeros((len(samples), len(samples[0])), dtype=np.float)
+        for i, features in enumerate(samples):
+            m[i, :] = features
+        return np.mean(m, axis=0)
+
+    return [sum(features[i] for features in samples) / len(samples) for i in range(len(samples[0]))]
+
+# int8量化：返回 (array('b'), scale)，原值约等于 q * scale
+def _quantize(v):
+    peak = max(abs(a) for a in v)
+    scale = peak / 127 if peak else 1.0
+    return array.array('b', [int(round(a / scale)) for a in v]), scale
+
 # 人脸处理模块
 class FaceProcessor:
-    def __init__(self, face_cascade, face_id_net, landmark_net):
+    def __init__(self, face_cascade, eye_cascade, face_id_net, landmark_net):
         self.face_cascade = face_cascade
+        self.eye_cascade = eye_cascade
         self.face_id_net = face_id_net
         self.landmark_net = landmark_net
 
+    # 在缩小图上检测，结果坐标还原到原图，特征提取仍用原图
     def detect(self, img):
-        return img.find_features(self.face_cascade, threshold=0.75, scale_factor=1.25)
+        s = SystemConfig.DETECT_SCALE
+        small = img.copy(x_scale=1.0 / s, y_scale=1.0 / s)
+        faces = small.find_features(self.face_cascade, threshold=0.75, scale_factor=1.25)
+        return [(x * s, y * s, w * s, h * s) for x, y, w, h in faces]
 
     def extract_descriptor(self, img, rect):
         if self.face_id_net is None:
@@ -127,7 +252,7 @@ class FaceProcessor:
         features = self.face_id_net.classify(
             face_roi, min_scale=1.0, scale_mul=0.8, x_overlap=0.5, y_overlap=0.5
         )[0].output()
-        return features
+        return _l2_normalize(features)
 
     def _align_face(self, img, face_rect):
         face_roi = img.copy(roi=face_rect)
@@ -142,54 +267,250 @@ class FaceProcessor:
         dy = right_eye[1] - left_eye[1]
         angle = math.atan2(dy, dx) * 180 / math.pi
 
-        img_aligned = img.copy()
-        img_aligned.rotate(angle)
-
-        cx, cy = (face_rect[0] + face_rect[2]//2, face_rect[1] + face_rect[3]//2)
-        w, h = face_rect[2], face_rect[3]
-        return img_aligned.copy(roi=(cx - w//2, cy - h//2, w, h))
+        # 只旋转已裁剪的人脸区域（绕人脸中心），不再复制整帧
+        face_roi.rotate(angle)
+        return face_roi
 
 # 用户数据库
 class UserDatabase:
-    def __init__(self, db_path):
-        self.db_path = db_path
+    def __init__(self, meta_path, bin_path, legacy_path=None):
+        self.meta_path = meta_path    # 元数据日志（每行一条JSON记录，只追加）
+        self.bin_path = bin_path      # 特征文件（int8特征依次拼接）
         self.users = {}
-        self._load()
-
-    def _load(self):
+        self._garbage = 0      # 日志中已失效的记录数，过多时压缩
+        self._loaded = False   # 特征是否已从特征文件读入内存
+        self._ids = []         # 与特征矩阵各行对应的用户ID
+        self._matrix = None    # (用户数, 特征维数) int8矩阵，None表示需要重建
+        self._factors = None   # 每行范数的倒数
+        self._load(legacy_path)
+
+    # 启动时只回放元数据日志，特征在首次比对时才读取
+    def _load(self, legacy_path):
+        self._recover()
         try:
-            with open(self.db_path, "r") as f:
-                self.users = json.load(f)
+            self.users, self._garbage, corrupt = self._replay()
             print(f"已加载 {len(self.users)} 个用户数据")
-        except Exception as e:
-            self.users = {}
-            print(f"用户数据库加载失败: {e}")
-            print("将创建新的用户数据库")
+            if corrupt:
+                # 残缺的最后一行之后不能再追加，否则新记录与其拼成一行，之后每次都无法解析
+                self.compact()
+            return
+        except OSError:
+            pass
+
+        if legacy_path:
+            try:
+                with open(legacy_path, "r") as f:
+                    self.users = json.load(f)
+                for user_data in self.users.values():
+                    self._prepare(user_data)
+                self._loaded = True
+                self.compact()
+                print(f"已导入旧版数据库 {len(self.users)} 个用户")
+                return
+            except Exception as e:
+                self.users = {}
+                print(f"用户数据库加载失败: {e}")
+
+        self._loaded = True
+        print("将创建新的用户数据库")
+
+    # 压缩中断后的恢复：元数据临时文件（".tmp"）只在两个新文件都写完后才出现，
+    # 它存在就补完替换，否则丢弃写到一半的临时文件，旧的两个文件仍然配套
+    def _recover(self):
+        if self._exists(self.meta_path + ".tmp"):
+            self._replace(self.bin_path)
+            self._replace(self.meta_path)
+            print("已恢复中断的用户数据库压缩")
+            return
+        for path in (self.bin_path + ".tmp", self.meta_path + ".new"):
+            if self._exists(path):
+                uos.remove(path)
+
+    @staticmethod
+    def _exists(path):
+        try:
+            uos.stat(path)
+            return True
+        except OSError:
+            return False
+
+    # 用临时文件替换正式文件（临时文件不存在时说明已经替换过）
+    def _replace(self, path):
+        if not self._exists(path + ".tmp"):
+            return
+        if self._exists(path):
+            uos.remove(path)
+        uos.rename(path + ".tmp", path)
+
+    def _replay(self):
+        users = {}
+        garbage = 0
+        corrupt = False
+        with open(self.meta_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 写入中断导致的残缺记录：保留之前已回放的数据
+                    print("用户元数据日志末尾损坏，已忽略")
+                    garbage += 1
+                    corrupt = True
+                    break
+                user_id = record.pop("id")
+                if record.pop("op") == "del":
+                    users.pop(user_id, None)
+                    garbage += 2
+                else:
+                    if user_id in users:
+                        garbage += 1
+                    users[user_id] = record
+        return users, garbage, corrupt
+
+    # 旧版JSON数据库的特征（浮点"descriptor"或base64编码的"q"）转为int8
+    def _prepare(self, user_data):
+        if "descriptor" in user_data:
+            descriptor = user_data.pop("descriptor")
+            if isinstance(descriptor, str):
+                descriptor = array.array('f', ubinascii.a2b_base64(descriptor))
+            if not user_data.pop("normalized", False):
+                descriptor = _l2_normalize(descriptor)
+            q, user_data["scale"] = _quantize(descriptor)
+        else:
+            q = array.array('b', ubinascii.a2b_base64(user_data.pop("q")))
+        self._attach(user_data, q)
+
+    # 特征以int8量化保存："_q"为array('b')，"scale"为反量化系数
+    # 量化向量的范数只算一次（"_"开头的字段只在内存中，不写入文件）
+    @staticmethod
+    def _attach(user_data, q):
+        user_data["_q"] = q
+        user_data["_norm"] = math.sqrt(sum(a * a for a in q))
+
+    # 按需从特征文件读入全部特征
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.bin_path, "rb") as f:
+                for user_data in self.users.values():
+                    f.seek(user_data["offset"])
+                    q = f.read(user_data["dim"])
+                    if len(q) == user_data["dim"]:
+                        self._attach(user_data, array.array('b', q))
+        except OSError as e:
+            print(f"特征文件读取失败: {e}")
+        missing = [user_id for user_id, user_data in self.users.items() if "_q" not in user_data]
+        for user_id in missing:
+            print(f"用户 {user_id} 的特征缺失，已忽略")
+            del self.users[user_id]
+
+    # 将所有用户特征堆叠为一个矩阵，识别时一次矩阵-向量乘法完成比对
+    def _rebuild_matrix(self):
+        self._ids = list(self.users.keys())
+        self._matrix = None
+        self._factors = None
+        if np is None or not self._ids:
+            return
+        dim = len(self.users[self._ids[0]]["_q"])
+        self._matrix = np.zeros((len(self._ids), dim), dtype=np.int8)
+        for i, user_id in enumerate(self._ids):
+            self._matrix[i, :] = np.frombuffer(self.users[user_id]["_q"], dtype=np.int8)
+        norms = [self.users[user_id]["_norm"] for user_id in self._ids]
+        self._factors = np.array([1 / n if n else 0.0 for n in norms], dtype=np.float)
+
+    def matrix(self):
+        self._ensure_loaded()
+        if self._matrix is None:
+            self._rebuild_matrix()
+        return self._ids, self._matrix, self._factors
+
+    def descriptors(self):
+        self._ensure_loaded()
+        return [(user_id, user_data["_q"], user_data["_norm"]) for user_id, user_data in self.users.items()]
 
-    def save(self):
+    @staticmethod
+    def _meta_record(user_id, user_data):
+        record = {k: v for k, v in user_data.items() if not k.startswith("_")}
+        record["op"] = "add"
+        record["id"] = user_id
+        return record
+
+    def _append_meta(self, record):
+        with open(self.meta_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    # 特征追加到特征文件末尾，返回其偏移
+    def _append_descriptor(self, q):
+        try:
+            offset = uos.stat(self.bin_path)[6]
+        except OSError:
+            offset = 0
+        with open(self.bin_path, "ab") as f:
+            f.write(q)
+        return offset
+
+    # 重写两个文件，去掉已删除和被覆盖的记录
+    def compact(self):
+        self._ensure_loaded()
         try:
-            with open(self.db_path, "w") as f:
-                json.dump(self.users, f)
+            with open(self.bin_path + ".tmp", "wb") as fb:
+                with open(self.meta_path + ".new", "w") as fm:
+                    offset = 0
+                    for user_id, user_data in self.users.items():
+                        q = user_data["_q"]
+                        fb.write(q)
+                        user_data["offset"] = offset
+                        user_data["dim"] = len(q)
+                        offset += len(q)
+                        fm.write(json.dumps(self._meta_record(user_id, user_data)) + "\n")
+            # 两个新文件都写完后才生成元数据临时文件，之后的替换中断时可由 _recover 补完
+            uos.rename(self.meta_path + ".new", self.meta_path + ".tmp")
+            self._replace(self.bin_path)
+            self._replace(self.meta_path)
+            self._garbage = 0
             return True
         except Exception as e:
-            print(f"保存用户数据失败: {e}")
+            print(f"压缩用户数据库失败: {e}")
             return False
 
     def add(self, name, descriptor):
         user_id = str(time.ticks_ms())
-        self.users[user_id] = {
+        q, scale = _quantize(_l2_normalize(descriptor))
+        user_data = {
             "name": name,
-            "descriptor": descriptor,
+            "scale": scale,
+            "dim": len(q),
             "registration_time": str(time.localtime()),
             "samples_count": 1
         }
-        return self.save(), user_id
+        try:
+            user_data["offset"] = self._append_descriptor(q)
+            self._append_meta(self._meta_record(user_id, user_data))
+        except Exception as e:
+            print(f"保存用户数据失败: {e}")
+            return False, user_id
+
+        self._attach(user_data, q)
+        self.users[user_id] = user_data
+        self._matrix = None
+        return True, user_id
 
     def delete(self, user_id):
-        if user_id in self.users:
-            del self.users[user_id]
-            return self.save()
-        return False
+        if user_id not in self.users:
+            return False
+        try:
+            self._append_meta({"op": "del", "id": user_id})
+        except Exception as e:
+            print(f"保存用户数据失败: {e}")
+            return False
+
+        del self.users[user_id]
+        self._matrix = None
+        self._garbage += 2
+        if self._garbage > len(self.users):
+            self.compact()
+        return True
 
     def get(self, user_id):
         return self.users.get(user_id)
@@ -197,28 +518,72 @@ class UserDatabase:
     def list_all(self):
         return list(self.users.items())
 
-# 相似度计算
-def cosine_similarity(feat1, feat2):
-    dot_product = sum(a * b for a, b in zip(feat1, feat2))
-    norm_a = sum(a * a for a in feat1) ** 0.5
-    norm_b = sum(b * b for b in feat2) ** 0.5
-    if norm_a == 0 or norm_b == 0:
+# int8点积（viper编译，4路展开）；ptr8读出的是无符号字节，(x ^ 128) - 128 还原符号
+@micropython.viper
+def _dot_int8(a: ptr8, b: ptr8, n: int) -> int:
+    s0 = 0
+    s1 = 0
+    s2 = 0
+    s3 = 0
+    i = 0
+    while i < n - 3:
+        s0 += ((a[i] ^ 128) - 128) * ((b[i] ^ 128) - 128)
+        s1 += ((a[i + 1] ^ 128) - 128) * ((b[i + 1] ^ 128) - 128)
+        s2 += ((a[i + 2] ^ 128) - 128) * ((b[i + 2] ^ 128) - 128)
+        s3 += ((a[i + 3] ^ 128) - 128) * ((b[i + 3] ^ 128) - 128)
+        i += 4
+    while i < n:
+        s0 += ((a[i] ^ 128) - 128) * ((b[i] ^ 128) - 128)
+        i += 1
+    return s0 + s1 + s2 + s3
+
+# 按特征维数生成完全展开的viper点积函数（去掉循环与边界判断）
+def _make_dot(dim):
+    terms = " + ".join(f"((a[{i}] ^ 128) - 128) * ((b[{i}] ^ 128) - 128)" for i in range(dim))
+    src = f"@micropython.viper\ndef _dot(a: ptr8, b: ptr8, n: int) -> int:\n    return {terms}\n"
+    scope = {"micropython": micropython}
+    exec(src, scope)
+    return scope["_dot"]
+
+# 各维数对应的点积函数，首次比对时生成；维数较大时代码过长，仍用循环版本
+_dot_kernels = {}
+
+def _dot_for(dim):
+    kernel = _dot_kernels.get(dim)
+    if kernel is None:
+        kernel = _make_dot(dim) if dim <= SystemConfig.DOT_UNROLL_MAX_DIM else _dot_int8
+        _dot_kernels[dim] = kernel
+    return kernel
+
+# 相似度计算（无ulab时使用）：两者范数已预先算好，只需计算点积
+def cosine_similarity_cached(query, q_norm, stored, s_norm):
+    if q_norm == 0 or s_norm == 0:
         return 0
-    return dot_product / (norm_a * norm_b)
+    n = len(query)
+    return _dot_for(n)(query, stored, n) / (q_norm * s_norm)
 
 # 活体检测
 def liveness_detection(face_processor, timeout_ms=5000):
+    if face_processor.eye_cascade is None:
+        return False
+
     start_time = time.ticks_ms()
     eyes_detected = False
     eyes_closed = False
+    last_face = None
+    frames_since_detect = 0
 
     while time.ticks_diff(time.ticks_ms(), start_time) < timeout_ms:
         img = sensor.snapshot()
-        faces = face_processor.detect(img)
 
-        if faces:
-            face = faces[0]
-            eyes = img.find_features(image.HaarCascade("eye"), threshold=0.75, scale_factor=1.25, roi=face)
+        if last_face is None or frames_since_detect >= SystemConfig.LIVENESS_REDETECT:
+            faces = face_processor.detect(img)
+            last_face = faces[0] if faces else None
+            frames_since_detect = 0
+        frames_since_detect += 1
+
+        if last_face:
+            eyes = img.find_features(face_processor.eye_cascade, threshold=0.75, scale_factor=1.25, roi=last_face)
 
             if eyes and not eyes_detected:
                 eyes_detected = True
@@ -237,10 +602,20 @@ def liveness_detection(face_processor, timeout_ms=5000):
 class FaceRecognitionSystem:
     def __init__(self):
         init_camera()
-        face_cascade, face_id_net, landmark_net = init_models()
+        face_cascade, eye_cascade, face_id_net, landmark_net = init_models()
 
-        self.face_processor = FaceProcessor(face_cascade, face_id_net, landmark_net)
-        self.user_db = UserDatabase(SystemConfig.DB_PATH)
+        self.face_processor = FaceProcessor(face_cascade, eye_cascade, face_id_net, landmark_net)
+        self.user_db = UserDatabase(SystemConfig.META_PATH, SystemConfig.DESCRIPTOR_PATH, SystemConfig.DB_PATH)
+        self._prev_thumb = None
+
+    # 帧差检测：与上一帧灰度缩略图比较，判断画面是否变化
+    def _scene_changed(self, img):
+        thumb = img.copy(x_scale=0.125, y_scale=0.125).to_grayscale()
+        prev, self._prev_thumb = self._prev_thumb, thumb
+        if prev is None:
+            return True
+        diff = thumb.copy().difference(prev).get_statistics().mean()
+        return diff > SystemConfig.MOTION_THRESHOLD
 
     def run(self):
         print("系统初始化完成")
@@ -264,33 +639,45 @@ class FaceRecognitionSystem:
         print("开始人脸识别，按选择键退出")
         print("="*30)
 
+        self._prev_thumb = None
+        frame_count = 0
+        result = None  # 上次检测结果 (人脸框, 标签, 颜色)，画面静止时沿用
+
         while True:
             img = sensor.snapshot()
-            faces = self.face_processor.detect(img)
+            frame_count += 1
 
-            if faces:
-                face = faces[0]
-                img.draw_rectangle(face)
+            if self._scene_changed(img) or frame_count % SystemConfig.DETECT_INTERVAL == 0:
+                result = None
+                faces = self.face_processor.detect(img)
 
-                descriptor = self.face_processor.extract_descriptor(img, face)
-                face_id = self._recognize_face(descriptor)
+                if faces:
+                    face = faces[0]
+                    descriptor = self.face_processor.extract_descriptor(img, face)
+                    face_id = self._recognize_face(descriptor)
+
+                    label, color = None, None
+                    if face_id:
+                        user_data = self.user_db.get(face_id)
+                        if user_data:
+                            label, color = f"{user_data['name']}", (0, 255, 0)
+                            print(f"识别结果: {user_data['name']}")
+                    else:
+                        label, color = "未知人脸", (255, 0, 0)
+                        print("识别结果: 未知人脸")
+                    result = (face, label, color)
 
-                if face_id:
-                    user_data = self.user_db.get(face_id)
-                    if user_data:
-                        img.draw_string(face[0], face[1]-15, f"{user_data['name']}", color=(0, 255, 0))
-                        print(f"识别结果: {user_data['name']}")
-                else:
-                    img.draw_string(face[0], face[1]-15, "未知人脸", color=(255, 0, 0))
-                    print("识别结果: 未知人脸")
+            if result:
+                face, label, color = result
+                img.draw_rectangle(face)
+                if label:
+                    img.draw_string(face[0], face[1]-15, label, color=color)
 
             if ButtonHandler.is_pressed(BTN_SELECT):
                 print("已退出识别模式")
                 time.sleep_ms(500)
                 break
 
-            time.sleep_ms(100)
-
     def _registration_mode(self):
         print("进入人脸注册模式")
         name = self._chinese_input("输入用户姓名")
@@ -319,7 +706,7 @@ class FaceRecognitionSystem:
                         continue
 
                     descriptor = self.face_processor.extract_descriptor(img, face)
-                    if descriptor:
+                    if descriptor is not None:
                         samples.append(descriptor)
                         print(f"已拍摄样本 {len(samples)}/{SystemConfig.REGISTRATION_SAMPLES}")
                     else:
@@ -338,7 +725,7 @@ class FaceRecognitionSystem:
             print("活体检测失败")
             return
 
-        avg_descriptor = [sum(features[i] for features in samples) / len(samples) for i in range(len(samples[0]))]
+        avg_descriptor = _mean_descriptor(samples)
         success, user_id = self.user_db.add(name, avg_descriptor)
 
         if success:
@@ -416,11 +803,28 @@ class FaceRecognitionSystem:
         if descriptor is None:
             return None
 
+        # 查询特征同样量化一次，范数在用户循环外计算一次
+        q, _ = _quantize(descriptor)
+        q_norm = math.sqrt(sum(a * a for a in q))
+        if q_norm == 0:
+            return None
+
+        if np is not None:
+            ids, matrix, factors = self.user_db.matrix()
+            if matrix is None:
+                return None
+            q = np.frombuffer(q, dtype=np.int8)
+            similarities = np.dot(matrix, q).flatten() * factors / q_norm
+            best = int(np.argmax(similarities))
+            if similarities[best] > SystemConfig.SIMILARITY_THRESHOLD:
+                return ids[best]
+            return None
+
         best_match_id = None
         highest_similarity = SystemConfig.SIMILARITY_THRESHOLD
 
-        for user_id, user_data in self.user_db.list_all():
-            similarity = cosine_similarity(descriptor, user_data["descriptor"])
+        for user_id, stored, s_norm in self.user_db.descriptors():
+            similarity = cosine_similarity_cached(q, q_norm, stored, s_norm)
             if similarity > highest_similarity:
                 highest_similarity = similarity
                 best_match_id = user_id
@@ -465,26 +869,29 @@ class FaceRecognitionSystem:
             print("-"*30)
             print("上/下: 选择 | 选择: 添加 | 返回: 删除 | 下页: 确认")
 
-            if ButtonHandler.is_pressed(BTN_UP):
+            buttons = ButtonHandler.snapshot()
+            chord = ButtonHandler.UP | ButtonHandler.DOWN
+
+            if (buttons & chord) == chord:
+                if current_text:
+                    return current_text
+                else:
+                    print("姓名不能为空！")
+                    time.sleep_ms(1000)
+            elif buttons & ButtonHandler.UP:
                 selected = (selected - 1) % len(chinese_chars[page])
-            elif ButtonHandler.is_pressed(BTN_DOWN):
+            elif buttons & ButtonHandler.DOWN:
                 selected = (selected + 1) % len(chinese_chars[page])
-            elif ButtonHandler.is_pressed(BTN_SELECT):
+            elif buttons & ButtonHandler.SELECT:
                 if page < len(chinese_chars) and len(current_text) < max_length:
                     current_text += chinese_chars[page][selected]
-            elif ButtonHandler.is_pressed(BTN_BACK):
+            elif buttons & ButtonHandler.BACK:
                 if current_text:
                     current_text = current_text[:-1]
                 else:
                     return ""
-            elif ButtonHandler.is_pressed(BTN_UP) and ButtonHandler.is_pressed(BTN_DOWN):
-                if current_text:
-                    return current_text
-                else:
-                    print("姓名不能为空！")
-                    time.sleep_ms(1000)
 
-            time.sleep_ms(100)
+            ButtonHandler.wait_event(100)
 
 if __name__ == "__main__":
     system = FaceRecognitionSystem()
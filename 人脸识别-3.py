@@ -1,25 +1,42 @@
-import sensor, image, time, tf, json, math
+import sensor, image, time, tf, json, math, uos, random
 from pyb import Pin
+from collections import namedtuple
+from ulab import numpy as np
 
 BTN_UP = Pin('P1', Pin.IN, Pin.PULL_UP)
 BTN_DOWN = Pin('P2', Pin.IN, Pin.PULL_UP)
 BTN_SELECT = Pin('P0', Pin.IN, Pin.PULL_UP)
 BTN_BACK = Pin('P3', Pin.IN, Pin.PULL_UP)
 
+# 按钮组用具名元组按属性访问，轮询时不做字典查找
+Buttons = namedtuple("Buttons", ("up", "down", "select", "back"))
+
 class Config:
     """系统配置类，集中管理所有参数"""
     DB_PATH = "user_database.json"
     FACE_MODEL = "face_recognition_model.kmodel"
     LANDMARK_MODEL = "landmark_model.kmodel"
     CASCADE_MODEL = "frontalface"
+    EYE_CASCADE_MODEL = "eye"
     DISPLAY_WIDTH = 320
     DISPLAY_HEIGHT = 240
     MIN_FACE_SIZE = 80
+    FACE_INPUT_SIZE = 96  # 人脸识别模型的输入尺寸
+    DETECT_SCALE = 2      # 人脸检测前的缩小倍数
     REGISTRATION_SAMPLES = 5
     SIMILARITY_THRESHOLD = 0.5
+    PRUNE_BLOCK = 16  # 逐个比对时每算完这么多维检查一次能否提前结束
+    LSH_MIN_USERS = 200   # 用户数达到该值时先用SimHash预筛选候选用户
+    LSH_BITS = 64         # SimHash签名位数（随机超平面个数）
+    LSH_CANDIDATES = 4    # 预筛选后精确比对的用户数
+    LSH_SEED = 1234       # 生成随机超平面的固定种子
     LIVENESS_TIMEOUT = 5000
     BUTTON_DEBOUNCE = 20
-    MENU_UPDATE_DELAY = 100
+    MOTION_THRESHOLD = 4  # 缩略图平均灰度差低于该值视为画面静止，沿用上次的人脸框
+    TRACK_IOU = 0.7       # 人脸框与上次提取特征时的重叠度高于该值时沿用上次的识别结果
+    MENU_POLL_DELAY = 10  # 菜单只在选项变化时重绘，其余时间以该间隔轮询按键
+    ENABLE_OVERLAY = False  # 是否在画面上绘制人脸框和文字，只有连接显示屏或IDE查看画面时才需要
+    FACE_MODEL_GRAYSCALE = False  # 人脸识别模型为单通道输入时设为True，以灰度图送入模型
 
 class Button:
     """按钮处理类，支持长按、短按等操作"""
@@ -27,38 +44,42 @@ class Button:
         self.pin = pin
         self.debounce = debounce
         self.last_state = 1
+        self.last_edge = 0       # 上次接受状态变化的时间
         self.pressed_time = 0
+        self.long_fired = False  # 本次按下是否已触发过长按
         self.long_press_threshold = 1000  # 长按阈值(ms)
 
-    def is_pressed(self):
-        """检测短按"""
+    def _update(self):
+        """读取引脚状态，距上次变化超过消抖时间才接受，返回是否刚被按下"""
         state = self.pin.value()
-        if state == 0 and self.last_state == 1:
-            time.sleep_ms(self.debounce)
-            if self.pin.value() == 0:
-                self.last_state = 0
-                self.pressed_time = time.ticks_ms()
+        now = time.ticks_ms()
+        if state != self.last_state and time.ticks_diff(now, self.last_edge) > self.debounce:
+            self.last_state = state
+            self.last_edge = now
+            if state == 0:
+                self.pressed_time = now
+                self.long_fired = False
                 return True
-        elif state == 1 and self.last_state == 0:
-            self.last_state = 1
         return False
 
+    def is_pressed(self):
+        """检测短按"""
+        return self._update()
+
     def is_long_pressed(self):
         """检测长按"""
-        state = self.pin.value()
-        if state == 0 and self.last_state == 1:
-            time.sleep_ms(self.debounce)
-            if self.pin.value() == 0:
-                self.last_state = 0
-                self.pressed_time = time.ticks_ms()
-        elif state == 0 and self.last_state == 0:
-            if time.ticks_diff(time.ticks_ms(), self.pressed_time) > self.long_press_threshold:
-                self.last_state = 1  # 避免重复触发
-                return True
-        elif state == 1 and self.last_state == 0:
-            self.last_state = 1
+        self._update()
+        if self.last_state == 0 and not self.long_fired and \
+           time.ticks_diff(time.ticks_ms(), self.pressed_time) > self.long_press_threshold:
+            self.long_fired = True  # 避免重复触发
+            return True
         return False
 
+    def held_for(self, ms):
+        """是否已持续按住超过ms毫秒（只读状态，不消耗长按事件，用于组合键）"""
+        return self.last_state == 0 and self.pin.value() == 0 and \
+            time.ticks_diff(time.ticks_ms(), self.pressed_time) > ms
+
 class Display:
     """显示处理类，统一管理屏幕输出"""
     @staticmethod
@@ -93,53 +114,78 @@ class Menu:
 
     def show(self, buttons):
         """显示菜单并处理用户输入"""
+        rendered = None  # 上次绘制时的选中项，未变化时不重绘
         while True:
-            Display.clear()
-            Display.show_title(self.title)
+            if rendered != self.selected:
+                rendered = self.selected
+                Display.clear()
+                Display.show_title(self.title)
 
-            for i, option in enumerate(self.options):
-                prefix = "→ " if i == self.selected else "   "
-                print(f"{prefix}{option}")
+                for i, option in enumerate(self.options):
+                    prefix = "→ " if i == self.selected else "   "
+                    print(f"{prefix}{option}")
 
-            print("="*30)
-            print("上: 上一项 | 下: 下一项 | 选择: 确认 | 返回: 后退")
+                print("="*30)
+                print("上: 上一项 | 下: 下一项 | 选择: 确认 | 返回: 后退")
 
-            if buttons["up"].is_pressed():
+            if buttons.up.is_pressed():
                 self.selected = (self.selected - 1) % len(self.options)
-            elif buttons["down"].is_pressed():
+            elif buttons.down.is_pressed():
                 self.selected = (self.selected + 1) % len(self.options)
-            elif buttons["select"].is_pressed():
+            elif buttons.select.is_pressed():
                 if self.selected in self.action_map:
                     return self.action_map[self.selected]()
                 else:
                     return self.selected
-            elif buttons["back"].is_pressed():
+            elif buttons.back.is_pressed():
                 return -1
 
-            time.sleep_ms(Config.MENU_UPDATE_DELAY)
+            time.sleep_ms(Config.MENU_POLL_DELAY)
 
 class FaceDetector:
     """人脸检测与特征提取类"""
     def __init__(self, cascade_model, face_model, landmark_model=None):
         self.face_cascade = image.HaarCascade(cascade_model)
+        self.eye_cascade = image.HaarCascade(Config.EYE_CASCADE_MODEL)
         self.face_id_net = tf.load(face_model) if face_model else None
         self.landmark_net = tf.load(landmark_model) if landmark_model else None
+        # 预分配的模型输入缓冲区，每帧复用；灰度模型直接用灰度缓冲区，画入时即完成转换
+        fmt = sensor.GRAYSCALE if Config.FACE_MODEL_GRAYSCALE else sensor.RGB565
+        self._face_buf = image.Image(Config.FACE_INPUT_SIZE, Config.FACE_INPUT_SIZE, fmt)
+        # 预分配的缩小灰度图，级联检测只需要灰度
+        self._small = image.Image(Config.DISPLAY_WIDTH // Config.DETECT_SCALE,
+                                  Config.DISPLAY_HEIGHT // Config.DETECT_SCALE, sensor.GRAYSCALE)
 
     def detect_faces(self, img):
-        """检测图像中的人脸"""
-        return img.find_features(self.face_cascade, threshold=0.75, scale_factor=1.25)
+        """检测图像中的人脸（在缩小的灰度图上检测，坐标还原到原图）"""
+        s = Config.DETECT_SCALE
+        self._small.draw_image(img, 0, 0, x_scale=1.0 / s, y_scale=1.0 / s)
+        faces = self._small.find_features(self.face_cascade, threshold=0.75, scale_factor=1.25)
+        return [(x * s, y * s, w * s, h * s) for x, y, w, h in faces]
+
+    def detect_eyes(self, img, roi):
+        """在人脸区域内检测眼睛"""
+        return img.find_features(self.eye_cascade, threshold=0.75, scale_factor=1.25, roi=roi)
 
     def extract_features(self, img, face_rect):
         """提取人脸特征向量"""
         if not self.face_id_net:
             return None
 
-        face_roi = self._align_face(img, face_rect) if self.landmark_net else img.copy(roi=face_rect)
-        face_roi = face_roi.resize(96, 96)
+        if self.landmark_net:
+            aligned = self._align_face(img, face_rect)
+            self._fill_face_buf(aligned, (0, 0, aligned.width(), aligned.height()))
+        else:
+            self._fill_face_buf(img, face_rect)
         return self.face_id_net.classify(
-            face_roi, min_scale=1.0, scale_mul=0.8, x_overlap=0.5, y_overlap=0.5
+            self._face_buf, min_scale=1.0, scale_mul=0.8, x_overlap=0.5, y_overlap=0.5
         )[0].output()
 
+    def _fill_face_buf(self, src, roi):
+        """把人脸区域缩放到铺满模型输入缓冲区（裁剪和缩放一次完成，不再分配新图像）"""
+        size = Config.FACE_INPUT_SIZE
+        self._face_buf.draw_image(src, 0, 0, x_scale=size / roi[2], y_scale=size / roi[3], roi=roi)
+
     def _align_face(self, img, face_rect):
         """人脸对齐处理"""
         face_roi = img.copy(roi=face_rect)
@@ -154,55 +200,120 @@ class FaceDetector:
         dy = right_eye[1] - left_eye[1]
         angle = math.atan2(dy, dx) * 180 / math.pi
 
-        img_aligned = img.copy()
-        img_aligned.rotate(angle)
-
-        cx, cy = (face_rect[0] + face_rect[2]//2, face_rect[1] + face_rect[3]//2)
-        w, h = face_rect[2], face_rect[3]
-        return img_aligned.copy(roi=(cx - w//2, cy - h//2, w, h))
+        # 只旋转已裁剪的人脸区域（绕人脸中心），不再复制整帧
+        face_roi.rotate(angle)
+        return face_roi
 
 class UserManager:
     """用户管理类，处理用户数据的增删改查"""
     def __init__(self, db_path):
         self.db_path = db_path
         self.users = self._load_db()
+        self._dirty = False           # 内存中有未写入文件的修改
+        self._user_ids = []           # 与特征矩阵各行对应的用户ID
+        self._feature_matrix = None   # (用户数, 特征维数) int8矩阵
+        self._factors = None          # 每行的反量化系数scale
+        self._recent = list(self.users.keys())  # 按最近匹配排序，矩阵放不下时按此顺序逐个比对
+        self._planes = None           # SimHash随机超平面 (LSH_BITS, 特征维数)，首次使用时生成
+        self._rebuild_matrix()
 
     def _load_db(self):
         """加载用户数据库"""
         try:
             with open(self.db_path, "r") as f:
-                return json.load(f)
+                users = json.load(f)
         except Exception:
             return {}
+        # 特征归一化后以int8量化保存（"q"、"scale"），在内存中为ndarray，只在写入文件时转回列表
+        # 旧版浮点特征在此重新量化
+        for user in users.values():
+            if "features" in user:
+                features = np.array(user.pop("features"), dtype=np.float)
+                user.pop("features_norm", None)
+                user["q"], user["scale"] = self._quantize(features)
+            else:
+                user["q"] = np.array(user["q"], dtype=np.int8)
+        return users
 
     def save_db(self):
-        """保存用户数据库"""
+        """保存用户数据库（先写临时文件再替换，避免写入中断损坏数据库）"""
+        tmp_path = self.db_path + ".tmp"
         try:
-            with open(self.db_path, "w") as f:
-                json.dump(self.users, f)
+            data = {}
+            for user_id, user in self.users.items():
+                # "_"开头的字段只在内存中使用
+                data[user_id] = {k: v for k, v in user.items() if not k.startswith("_")}
+                data[user_id]["q"] = user["q"].tolist()
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+            try:
+                uos.remove(self.db_path)
+            except OSError:
+                pass
+            uos.rename(tmp_path, self.db_path)
+            self._dirty = False
             return True
         except Exception as e:
             print(f"保存数据库失败: {e}")
             return False
 
+    def flush(self):
+        """有未保存的修改时写入文件"""
+        if not self._dirty:
+            return True
+        return self.save_db()
+
     def add_user(self, name, features):
         """添加新用户"""
         user_id = str(time.ticks_ms())
+        q, scale = self._quantize(np.array(features, dtype=np.float))
         self.users[user_id] = {
             "name": name,
-            "features": features,
+            "q": q,
+            "scale": scale,
             "registered_at": str(time.localtime()),
             "samples_count": 1
         }
-        return self.save_db(), user_id
+        self._recent.append(user_id)
+        self._append_row(user_id)
+        self._dirty = True
+        return True, user_id
+
+    def update_features(self, user_id, features, samples_count):
+        """更新用户特征"""
+        user = self.users[user_id]
+        user["q"], user["scale"] = self._quantize(np.array(features, dtype=np.float))
+        user.pop("_suffix", None)
+        user.pop("_sig", None)
+        user["samples_count"] = samples_count
+        self._rebuild_matrix()
+        self._dirty = True
+        return True
+
+    def rename_user(self, user_id, name):
+        """重命名用户"""
+        self.users[user_id]["name"] = name
+        self._dirty = True
+        return True
 
     def delete_user(self, user_id):
         """删除用户"""
         if user_id in self.users:
             del self.users[user_id]
-            return self.save_db()
+            self._recent.remove(user_id)
+            self._rebuild_matrix()
+            self._dirty = True
+            return True
         return False
 
+    def clear_users(self):
+        """删除全部用户"""
+        self.users = {}
+        self._recent = []
+        self._rebuild_matrix()
+        self._dirty = True
+        return True
+
     def get_user(self, user_id):
         """获取用户信息"""
         return self.users.get(user_id)
@@ -213,29 +324,154 @@ class UserManager:
 
     def find_user_by_features(self, features, threshold=Config.SIMILARITY_THRESHOLD):
         """通过特征查找用户"""
-        if not features:
+        if features is None:
             return None
 
-        best_match = None
-        highest_similarity = threshold
+        # 查询特征每帧只归一化、量化一次
+        q, scale = self._quantize(np.array(features, dtype=np.float))
+        if scale == 0 or not self.users:
+            return None
+
+        if len(self.users) >= Config.LSH_MIN_USERS:
+            best_match = self._find_lsh(q, scale, threshold)
+        elif self._feature_matrix is not None:
+            # 特征均为单位向量，一次int8矩阵-向量乘法再乘以双方scale即为余弦相似度，无需开方和除法
+            scores = np.dot(self._feature_matrix, q).flatten() * self._factors * scale
+            idx = int(np.argmax(scores))
+            best_match = self._user_ids[idx] if scores[idx] > threshold else None
+        else:
+            best_match = self._find_pruned(q, scale, threshold)
 
-        for user_id, user_data in self.users.items():
-            similarity = self._cosine_similarity(features, user_data["features"])
-            if similarity > highest_similarity:
-                highest_similarity = similarity
+        if best_match is not None and self._recent[0] != best_match:
+            self._recent.remove(best_match)
+            self._recent.insert(0, best_match)
+        return best_match
+
+    def _find_lsh(self, q, q_scale, threshold):
+        """按SimHash签名的汉明距离预筛选，只对最接近的几个用户精确比对"""
+        q_sig = self._signature(q)
+        dists = []
+        for user_id, user in self.users.items():
+            sig = user.get("_sig")
+            if sig is None:
+                sig = user["_sig"] = self._signature(user["q"])
+            dists.append((bin(q_sig ^ sig).count("1"), user_id))
+        dists.sort()
+
+        best_match = None
+        best = threshold
+        for _, user_id in dists[:Config.LSH_CANDIDATES]:
+            user = self.users[user_id]
+            similarity = np.dot(user["q"], q) * user["scale"] * q_scale
+            if similarity > best:
+                best = similarity
                 best_match = user_id
+        return best_match
+
+    def _signature(self, q):
+        """计算SimHash签名：第k位表示特征在第k个随机超平面的哪一侧"""
+        if self._planes is None or self._planes.shape[1] != len(q):
+            random.seed(Config.LSH_SEED)
+            self._planes = np.array([[1 if random.getrandbits(1) else -1 for _ in range(len(q))]
+                                     for _ in range(Config.LSH_BITS)], dtype=np.int8)
+        sig = 0
+        for k, v in enumerate(np.dot(self._planes, q)):
+            if v > 0:
+                sig |= 1 << k
+        return sig
+
+    def _find_pruned(self, q, q_factor, threshold):
+        """逐个用户比对，点积已不可能超过当前最优时提前结束（特征矩阵放不下时使用）"""
+        block = Config.PRUNE_BLOCK
+        dim = len(q)
+        best_match = None
+        best = threshold
+
+        for user_id in self._recent:
+            user = self.users[user_id]
+            if not user["scale"]:
+                continue
+            factor = user["scale"] * q_factor
+            need = best / factor  # 点积需超过该值才能成为新的最优
+            u = user["q"]
+            suffix = self._suffix_bounds(user)
+
+            dot = 0
+            for i, start in enumerate(range(0, dim, block)):
+                dot += np.dot(q[start:start + block], u[start:start + block])
+                # 量化后|q|不超过127，剩余维度的点积不超过 127 * 用户剩余维度绝对值之和
+                if dot + 127 * suffix[i + 1] <= need:
+                    break
+            else:
+                if dot > need:
+                    best = dot * factor
+                    best_match = user_id
 
         return best_match
 
     @staticmethod
-    def _cosine_similarity(feat1, feat2):
-        """计算余弦相似度"""
-        dot_product = sum(a * b for a, b in zip(feat1, feat2))
-        norm_a = sum(a * a for a in feat1) ** 0.5
-        norm_b = sum(b * b for b in feat2) ** 0.5
-        if norm_a == 0 or norm_b == 0:
-            return 0
-        return dot_product / (norm_a * norm_b)
+    def _suffix_bounds(user):
+        """各分块起始处之后用户特征绝对值之和（首次使用时计算并缓存）"""
+        suffix = user.get("_suffix")
+        if suffix is None:
+            block = Config.PRUNE_BLOCK
+            u = user["q"]
+            sums = [np.sum(abs(np.array(u[start:start + block], dtype=np.float)))
+                    for start in range(0, len(u), block)]
+            suffix = [0.0] * (len(sums) + 1)
+            for i in range(len(sums) - 1, -1, -1):
+                suffix[i] = suffix[i + 1] + sums[i]
+            user["_suffix"] = suffix
+        return suffix
+
+    def _row(self, user_id):
+        """返回用户的int8特征（1行矩阵）及其系数"""
+        user = self.users[user_id]
+        q = user["q"]
+        return q.reshape((1, len(q))), user["scale"]
+
+    def _rebuild_matrix(self):
+        """从全部用户重建特征矩阵"""
+        self._user_ids = list(self.users.keys())
+        if not self._user_ids:
+            self._feature_matrix = None
+            self._factors = None
+            return
+        try:
+            rows = [self._row(user_id) for user_id in self._user_ids]
+            self._feature_matrix = np.concatenate([row for row, _ in rows])
+            self._factors = np.array([factor for _, factor in rows], dtype=np.float)
+        except MemoryError:
+            self._feature_matrix = None
+            self._factors = None
+            print("内存不足，无法建立特征矩阵，改为逐个比对")
+
+    def _append_row(self, user_id):
+        """新增用户时在矩阵末尾追加一行"""
+        if self._feature_matrix is None:
+            self._rebuild_matrix()
+            return
+        row, factor = self._row(user_id)
+        try:
+            self._feature_matrix = np.concatenate((self._feature_matrix, row))
+            self._factors = np.concatenate((self._factors, np.array([factor], dtype=np.float)))
+        except MemoryError:
+            self._feature_matrix = None
+            self._factors = None
+            print("内存不足，无法建立特征矩阵，改为逐个比对")
+            return
+        self._user_ids.append(user_id)
+
+    @staticmethod
+    def _quantize(features):
+        """归一化后int8量化，返回 (q, scale)，单位向量约等于 q * scale（零向量的scale为0）"""
+        norm = math.sqrt(np.dot(features, features))
+        if norm == 0:
+            return np.zeros(len(features), dtype=np.int8), 0.0
+        features = features / norm
+        scale = np.max(abs(features)) / 127
+        q = np.array(np.around(features / scale), dtype=np.int8)
+        return q, scale
 
 class ChineseInput:
     """中文输入法类"""
@@ -249,56 +485,69 @@ class ChineseInput:
         "和穆萧尹姚邵湛汪祁毛禹狄米贝明臧",
         "计伏成戴谈宋茅庞熊纪舒屈项祝董梁"
     ]
+    ROW_SIZE = 4
 
     def __init__(self, title="输入姓名", max_length=8):
         self.title = title
         self.max_length = max_length
+        # 每页按行预先排好的字符和不含选中标记的行文本，绘制时只需重新格式化选中的那一行
+        n = self.ROW_SIZE
+        self._page_rows = [[chars[i:i+n] for i in range(0, len(chars), n)] for chars in self.CHAR_SETS]
+        self._page_lines = [["".join(f" {c}  " for c in row) for row in rows] for rows in self._page_rows]
 
     def input(self, buttons):
         """获取用户输入的中文字符串"""
         current_text = ""
         page = 0
         selected = 0
+        rendered = None  # 上次绘制时的 (页, 选中项, 已输入文字)，未变化时不重绘
+        chord_fired = False  # 本次按住组合键是否已触发，松开后才能再次触发
 
         while True:
-            Display.clear()
-            Display.show_title(self.title)
-            print(f"当前输入: {current_text}")
-            print("-"*30)
-
-            if page < len(self.CHAR_SETS):
-                chars = self.CHAR_SETS[page]
-                for i in range(0, len(chars), 4):
-                    line = ""
-                    for j in range(4):
-                        if i+j < len(chars):
-                            prefix = "[" if i+j == selected else " "
-                            suffix = "]" if i+j == selected else " "
-                            line += f"{prefix}{chars[i+j]}{suffix} "
-                    print(line)
-
-            print("-"*30)
-            print("上: 上一项 | 下: 下一项 | 选择: 添加 | 返回: 删除 | 长按上+下: 确认")
-
-            if buttons["up"].is_pressed():
+            state = (page, selected, current_text)
+            if state != rendered:
+                rendered = state
+                Display.clear()
+                Display.show_title(self.title)
+                print(f"当前输入: {current_text}")
+                print("-"*30)
+
+                if page < len(self.CHAR_SETS):
+                    selected_row, selected_col = divmod(selected, self.ROW_SIZE)
+                    for r, line in enumerate(self._page_lines[page]):
+                        if r == selected_row:
+                            row = self._page_rows[page][r]
+                            line = "".join(f"[{c}] " if j == selected_col else f" {c}  "
+                                           for j, c in enumerate(row))
+                        print(line)
+
+                print("-"*30)
+                print("上: 上一项 | 下: 下一项 | 选择: 添加 | 返回: 删除 | 长按上+下: 确认")
+
+            if buttons.up.is_pressed():
                 selected = (selected - 1) % len(self.CHAR_SETS[page])
-            elif buttons["down"].is_pressed():
+            elif buttons.down.is_pressed():
                 selected = (selected + 1) % len(self.CHAR_SETS[page])
-            elif buttons["select"].is_pressed():
+            elif buttons.select.is_pressed():
                 if page < len(self.CHAR_SETS) and len(current_text) < self.max_length:
                     current_text += self.CHAR_SETS[page][selected]
-            elif buttons["back"].is_pressed():
+            elif buttons.back.is_pressed():
                 if current_text:
                     current_text = current_text[:-1]
                 else:
                     return ""  # 取消输入
-            elif buttons["up"].is_long_pressed() and buttons["down"].is_long_pressed():
-                if current_text:
-                    return current_text
-                else:
+            elif buttons.up.held_for(buttons.up.long_press_threshold) and \
+                    buttons.down.held_for(buttons.down.long_press_threshold):
+                if not chord_fired:
+                    chord_fired = True
+                    if current_text:
+                        return current_text
                     Display.show_message("姓名不能为空！")
+                    rendered = None
+            else:
+                chord_fired = False
 
-            time.sleep_ms(Config.MENU_UPDATE_DELAY)
+            time.sleep_ms(Config.MENU_POLL_DELAY)
 
 class FaceRecognitionApp:
     """人脸识别应用主类"""
@@ -307,12 +556,12 @@ class FaceRecognitionApp:
         self._init_hardware()
 
         # 初始化组件
-        self.buttons = {
-            "up": Button(BTN_UP),
-            "down": Button(BTN_DOWN),
-            "select": Button(BTN_SELECT),
-            "back": Button(BTN_BACK)
-        }
+        self.buttons = Buttons(
+            Button(BTN_UP),
+            Button(BTN_DOWN),
+            Button(BTN_SELECT),
+            Button(BTN_BACK)
+        )
 
         self.face_detector = FaceDetector(
             Config.CASCADE_MODEL,
@@ -322,6 +571,13 @@ class FaceRecognitionApp:
 
         self.user_manager = UserManager(Config.DB_PATH)
 
+        # 运动检测状态（识别模式）
+        self._prev_gray = None
+        self._last_faces = None
+        # 已识别人脸的缓存：[{"rect": 提取特征时的人脸框, "user_id": 识别结果}]
+        self._tracks = []
+        self._missed_frames = 0
+
     def _init_hardware(self):
         """初始化摄像头"""
         sensor.reset()
@@ -350,29 +606,90 @@ class FaceRecognitionApp:
 
         while True:
             main_menu.show(self.buttons)
+            # 从子菜单返回时统一写入本次的修改
+            self.user_manager.flush()
 
     def _recognition_mode(self):
         """人脸识别模式"""
         Display.show_message("开始人脸识别，按返回键退出")
+        self._prev_gray = None
+        self._last_faces = None
+        self._tracks = []
+        self._missed_frames = 0
 
         while True:
             img = sensor.snapshot()
-            faces = self.face_detector.detect_faces(img)
+            if self._is_static(img) and self._last_faces is not None:
+                faces = self._last_faces
+            else:
+                faces = self.face_detector.detect_faces(img)
+                self._last_faces = faces
 
             if faces:
+                tracks = []
                 for face in faces:
-                    features = self.face_detector.extract_features(img, face)
-                    user_id = self.user_manager.find_user_by_features(features)
-
-                    if user_id:
-                        user = self.user_manager.get_user(user_id)
-                        Display.draw_face_info(img, face, user["name"], (0, 255, 0))
-                    else:
-                        Display.draw_face_info(img, face, "未知人脸", (255, 0, 0))
+                    # 人脸基本没动时沿用上次的识别结果，跳过特征提取
+                    track = self._find_track(face)
+                    if track is None:
+                        features = self.face_detector.extract_features(img, face)
+                        track = {"rect": face, "user_id": self.user_manager.find_user_by_features(features)}
+                        if not Config.ENABLE_OVERLAY:
+                            # 不绘制画面时只在识别出新结果时输出一次
+                            self._print_result(track["user_id"])
+                    tracks.append(track)
+
+                    if Config.ENABLE_OVERLAY:
+                        user_id = track["user_id"]
+                        if user_id:
+                            user = self.user_manager.get_user(user_id)
+                            Display.draw_face_info(img, face, user["name"], (0, 255, 0))
+                        else:
+                            Display.draw_face_info(img, face, "未知人脸", (255, 0, 0))
+                self._tracks = tracks
+                self._missed_frames = 0
+            else:
+                # 连续多帧没有人脸才清空缓存，避免偶尔漏检导致重新提取
+                self._missed_frames += 1
+                if self._missed_frames > 1:
+                    self._tracks = []
 
-            if self.buttons["back"].is_pressed():
+            if self.buttons.back.is_pressed():
                 break
 
+    def _print_result(self, user_id):
+        """输出识别结果"""
+        if user_id:
+            print("识别到用户: {}".format(self.user_manager.get_user(user_id)["name"]))
+        else:
+            print("未知人脸")
+
+    def _find_track(self, face):
+        """查找与人脸框重叠度足够高的缓存结果"""
+        for track in self._tracks:
+            if self._iou(track["rect"], face) > Config.TRACK_IOU:
+                return track
+        return None
+
+    @staticmethod
+    def _iou(a, b):
+        """计算两个矩形的交并比"""
+        w = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+        h = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+        if w <= 0 or h <= 0:
+            return 0.0
+        inter = w * h
+        return inter / (a[2] * a[3] + b[2] * b[3] - inter)
+
+    def _is_static(self, img):
+        """与上次检测时的灰度缩略图比较，判断画面是否静止（有变化时以当前帧为新的参照）"""
+        gray = img.copy(x_scale=0.125, y_scale=0.125).to_grayscale()
+        if self._prev_gray is not None:
+            diff = gray.copy().difference(self._prev_gray).get_statistics().mean()
+            if diff < Config.MOTION_THRESHOLD:
+                return True
+        self._prev_gray = gray
+        return False
+
     def _registration_mode(self):
         """人脸注册模式"""
         Display.show_message("进入人脸注册模式")
@@ -387,33 +704,41 @@ class FaceRecognitionApp:
 
         Display.show_message(f"用户姓名: {name}\n请将人脸对准摄像头\n按上键拍照，按返回键完成注册")
 
-        samples = []
-        while len(samples) < Config.REGISTRATION_SAMPLES:
+        # 特征逐个累加求均值，不保留每个样本
+        acc = None
+        count = 0
+        while count < Config.REGISTRATION_SAMPLES:
             img = sensor.snapshot()
             faces = self.face_detector.detect_faces(img)
 
             if faces:
                 face = max(faces, key=lambda f: f[2] * f[3])  # 选择最大的人脸
-                img.draw_rectangle(face)
-                img.draw_string(face[0], face[1]-10,
-                               f"样本 {len(samples)+1}/{Config.REGISTRATION_SAMPLES}")
+                if Config.ENABLE_OVERLAY:
+                    img.draw_rectangle(face)
+                    img.draw_string(face[0], face[1]-10,
+                                   f"样本 {count+1}/{Config.REGISTRATION_SAMPLES}")
 
-                if self.buttons["up"].is_pressed():
+                if self.buttons.up.is_pressed():
                     if face[2] < Config.MIN_FACE_SIZE or face[3] < Config.MIN_FACE_SIZE:
                         Display.show_message("人脸距离太远，请靠近摄像头")
                         continue
 
                     features = self.face_detector.extract_features(img, face)
-                    if features:
-                        samples.append(features)
-                        Display.show_message(f"已拍摄样本 {len(samples)}/{Config.REGISTRATION_SAMPLES}")
+                    if features is not None:
+                        features = np.array(features, dtype=np.float)
+                        if acc is None:
+                            acc = features
+                        else:
+                            acc += features
+                        count += 1
+                        Display.show_message(f"已拍摄样本 {count}/{Config.REGISTRATION_SAMPLES}")
                     else:
                         Display.show_message("未提取到有效特征，请调整角度")
 
-            if self.buttons["back"].is_pressed() and samples:
+            if self.buttons.back.is_pressed() and count:
                 break
 
-        if not samples:
+        if not count:
             Display.show_message("注册失败：未采集到有效样本")
             return
 
@@ -424,7 +749,7 @@ class FaceRecognitionApp:
             return
 
         # 计算平均特征
-        avg_features = [sum(f[i] for f in samples) / len(samples) for i in range(len(samples[0]))]
+        avg_features = acc / count
 
         # 保存用户
         success, user_id = self.user_manager.add_user(name, avg_features)
@@ -446,8 +771,7 @@ class FaceRecognitionApp:
 
             if faces:
                 face = faces[0]
-                eyes = img.find_features(image.HaarCascade("eye"), threshold=0.75,
-                                        scale_factor=1.25, roi=face)
+                eyes = self.face_detector.detect_eyes(img, face)
 
                 if eyes and not eyes_detected:
                     eyes_detected = True
@@ -455,7 +779,7 @@ class FaceRecognitionApp:
                     eyes_closed = True
                     break
 
-            if self.buttons["back"].is_pressed():
+            if self.buttons.back.is_pressed():
                 break
 
             time.sleep_ms(100)
@@ -519,8 +843,15 @@ class FaceRecognitionApp:
         print("="*30)
         print("按任意键返回")
 
-        while not any(btn.is_pressed() for btn in self.buttons.values()):
-            time.sleep_ms(100)
+        self._wait_any_button()
+
+    def _wait_any_button(self):
+        """等待任意按键按下"""
+        # 按钮取到局部变量并直接用or连接，不再每次轮询都创建生成器、遍历字典
+        up, down = self.buttons.up, self.buttons.down
+        select, back = self.buttons.select, self.buttons.back
+        while not (up.is_pressed() or down.is_pressed() or select.is_pressed() or back.is_pressed()):
+            time.sleep_ms(Config.MENU_POLL_DELAY)
 
     def _rename_user(self, user_id):
         """重命名用户"""
@@ -533,8 +864,7 @@ class FaceRecognitionApp:
         new_name = inputer.input(self.buttons)
 
         if new_name and new_name != user['name']:
-            user['name'] = new_name
-            if self.user_manager.save_db():
+            if self.user_manager.rename_user(user_id, new_name):
                 Display.show_message(f"已重命名为: {new_name}")
             else:
                 Display.show_message("保存失败")
@@ -548,41 +878,47 @@ class FaceRecognitionApp:
 
         Display.show_message(f"为用户 {user['name']} 重新采集人脸\n请将人脸对准摄像头\n按上键拍照，按返回键完成")
 
-        samples = []
-        while len(samples) < Config.REGISTRATION_SAMPLES:
+        # 特征逐个累加求均值，不保留每个样本
+        acc = None
+        count = 0
+        while count < Config.REGISTRATION_SAMPLES:
             img = sensor.snapshot()
             faces = self.face_detector.detect_faces(img)
 
             if faces:
                 face = max(faces, key=lambda f: f[2] * f[3])
-                img.draw_rectangle(face)
-                img.draw_string(face[0], face[1]-10,
-                               f"样本 {len(samples)+1}/{Config.REGISTRATION_SAMPLES}")
+                if Config.ENABLE_OVERLAY:
+                    img.draw_rectangle(face)
+                    img.draw_string(face[0], face[1]-10,
+                                   f"样本 {count+1}/{Config.REGISTRATION_SAMPLES}")
 
-                if self.buttons["up"].is_pressed():
+                if self.buttons.up.is_pressed():
                     if face[2] < Config.MIN_FACE_SIZE or face[3] < Config.MIN_FACE_SIZE:
                         Display.show_message("人脸距离太远，请靠近摄像头")
                         continue
 
                     features = self.face_detector.extract_features(img, face)
-                    if features:
-                        samples.append(features)
-                        Display.show_message(f"已拍摄样本 {len(samples)}/{Config.REGISTRATION_SAMPLES}")
+                    if features is not None:
+                        features = np.array(features, dtype=np.float)
+                        if acc is None:
+                            acc = features
+                        else:
+                            acc += features
+                        count += 1
+                        Display.show_message(f"已拍摄样本 {count}/{Config.REGISTRATION_SAMPLES}")
                     else:
                         Display.show_message("未提取到有效特征，请调整角度")
 
-            if self.buttons["back"].is_pressed() and samples:
+            if self.buttons.back.is_pressed() and count:
                 break
 
-        if not samples:
+        if not count:
             Display.show_message("采集失败：未获取到有效样本")
             return
 
-        avg_features = [sum(f[i] for f in samples) / len(samples) for i in range(len(samples[0]))]
-        user['features'] = avg_features
-        user['samples_count'] = len(samples)
+        avg_features = acc / count
 
-        if self.user_manager.save_db():
+        if self.user_manager.update_features(user_id, avg_features, count):
             Display.show_message("人脸特征已更新")
         else:
             Display.show_message("保存失败")
@@ -608,12 +944,14 @@ class FaceRecognitionApp:
         settings_menu = Menu("系统设置", [
             "识别阈值: {:.1f}".format(Config.SIMILARITY_THRESHOLD),
             "活体检测: {}".format("开启" if Config.LIVENESS_TIMEOUT > 0 else "关闭"),
+            "画面标注: {}".format("开启" if Config.ENABLE_OVERLAY else "关闭"),
             "重置数据库", "返回"
         ], {
             0: self._adjust_threshold,
             1: self._toggle_liveness_detection,
-            2: self._reset_database,
-            3: lambda: -1
+            2: self._toggle_overlay,
+            3: self._reset_database,
+            4: lambda: -1
         })
 
         settings_menu.show(self.buttons)
@@ -621,26 +959,29 @@ class FaceRecognitionApp:
     def _adjust_threshold(self):
         """调整识别阈值"""
         current_threshold = Config.SIMILARITY_THRESHOLD
+        rendered = None  # 上次绘制时的阈值，未变化时不重绘
         while True:
-            Display.clear()
-            Display.show_title("调整识别阈值")
-            print(f"当前阈值: {current_threshold:.1f}")
-            print("="*30)
-            print("上: 增加 0.1 | 下: 减少 0.1")
-            print("选择: 确认 | 返回: 取消")
-
-            if self.buttons["up"].is_pressed():
+            if rendered != current_threshold:
+                rendered = current_threshold
+                Display.clear()
+                Display.show_title("调整识别阈值")
+                print(f"当前阈值: {current_threshold:.1f}")
+                print("="*30)
+                print("上: 增加 0.1 | 下: 减少 0.1")
+                print("选择: 确认 | 返回: 取消")
+
+            if self.buttons.up.is_pressed():
                 current_threshold = min(1.0, current_threshold + 0.1)
-            elif self.buttons["down"].is_pressed():
+            elif self.buttons.down.is_pressed():
                 current_threshold = max(0.1, current_threshold - 0.1)
-            elif self.buttons["select"].is_pressed():
+            elif self.buttons.select.is_pressed():
                 Config.SIMILARITY_THRESHOLD = current_threshold
                 Display.show_message(f"已设置识别阈值为: {current_threshold:.1f}")
                 break
-            elif self.buttons["back"].is_pressed():
+            elif self.buttons.back.is_pressed():
                 break
 
-            time.sleep_ms(Config.MENU_UPDATE_DELAY)
+            time.sleep_ms(Config.MENU_POLL_DELAY)
 
     def _toggle_liveness_detection(self):
         """切换活体检测状态"""
@@ -651,14 +992,18 @@ class FaceRecognitionApp:
             Config.LIVENESS_TIMEOUT = 5000
             Display.show_message("活体检测已开启")
 
+    def _toggle_overlay(self):
+        """切换画面标注"""
+        Config.ENABLE_OVERLAY = not Config.ENABLE_OVERLAY
+        Display.show_message("画面标注已{}".format("开启" if Config.ENABLE_OVERLAY else "关闭"))
+
     def _reset_database(self):
         """重置数据库"""
         confirm_menu = Menu("确认重置数据库?", ["确认", "取消"])
         choice = confirm_menu.show(self.buttons)
 
         if choice == 0:
-            self.user_manager.users = {}
-            if self.user_manager.save_db():
+            if self.user_manager.clear_users():
                 Display.show_message("数据库已重置")
             else:
                 Display.show_message("重置失败")
@@ -672,11 +1017,11 @@ class FaceRecognitionApp:
         print("="*30)
         print("按任意键返回")
 
-        while not any(btn.is_pressed() for btn in self.buttons.values()):
-            time.sleep_ms(100)
+        self._wait_any_button()
 
     def _exit_system(self):
         """退出系统"""
+        self.user_manager.flush()
         Display.show_message("系统已关闭")
         return -1
 
@@ -1,20 +1,39 @@
+import sys
 import time
 import json
+import random
+import uos
+import micropython
+import machine
 import sensor
 import image
+import tf
+from ulab import numpy as np
 
 # 系统配置类，集中管理所有参数
 class Config:
-    DB_PATH = "user_database.json"
+    DB_PATH = "user_database.json"      # 旧版数据库，首次启动时导入日志
+    USER_LOG_PATH = "user_database.log"  # 用户数据库日志，修改只追加一行，不重写整个文件
+    FEATURE_PATH = "user_features.bin"   # int8特征依次拼接的二进制文件，日志中只记录偏移和长度
+    LOG_COMPACT_MIN = 32                 # 日志中失效记录超过该值且超过用户数时整体重写
     FACE_MODEL = "face_recognition_model.kmodel"
-    LANDMARK_MODEL = "landmark_model.kmodel"
     CASCADE_MODEL = "frontalface"
+    EYE_CASCADE_MODEL = "eye"
     DISPLAY_WIDTH = 320
     DISPLAY_HEIGHT = 240
     MIN_FACE_SIZE = 80
+    FACE_INPUT_SIZE = 96  # 人脸识别模型的输入尺寸
+    DETECT_SCALE = 2  # 人脸检测前的缩小倍数，最小人脸较大，缩小后检测不会漏检
     REGISTRATION_SAMPLES = 5
     SIMILARITY_THRESHOLD = 0.5
+    LSH_MIN_USERS = 200  # 用户数达到该值时按局部敏感哈希分桶，只比对同桶及相邻桶的用户
+    LSH_TABLES = 4       # 哈希表个数，任一表中同桶或相邻桶即为候选，表越多漏检越少
+    LSH_BITS = 8         # 每个哈希表的位数（随机超平面个数）
+    LSH_SEED = 1234      # 生成随机超平面的固定种子，每次启动得到相同的超平面，无需另存
+    TRACK_IOU = 0.8   # 人脸框与上一帧的重叠度不低于该值时沿用上一帧的识别结果
+    TRACK_TTL = 10    # 沿用识别结果的最多帧数，之后重新识别
     LIVENESS_TIMEOUT = 5000
+    LIVENESS_REDETECT = 1000  # 活体检测时还没找到眼睛，每隔该时间(ms)重新检测人脸位置
     BUTTON_DEBOUNCE = 20
     MENU_UPDATE_DELAY = 100
 
@@ -23,42 +42,55 @@ class Button:
     def __init__(self, pin, debounce=Config.BUTTON_DEBOUNCE):
         self.pin = pin
         self.debounce = debounce
-        self.last_state = 1
         self.pressed_time = 0
         self.long_press_threshold = 1000  # 长按阈值(ms)
-
+        # 按下由下降沿中断记录，轮询时只读标志，不读引脚也不阻塞消抖
+        self._pending_press = False
+        self._last_edge = 0
+        pin.irq(trigger=pin.IRQ_FALLING | pin.IRQ_RISING, handler=self._on_edge)
+
+    # 中断处理：引脚为低且之前已稳定超过消抖时间才记为一次按下，抖动产生的边沿只刷新时间（中断中不分配内存）
+    def _on_edge(self, pin):
+        now = time.ticks_ms()
+        if pin.value() == 0 and time.ticks_diff(now, self._last_edge) > self.debounce:
+            self.pressed_time = now
+            self._pending_press = True
+        self._last_edge = now
+
+    # 读取并清除按下标志，关中断保证读和清之间到来的按下不会丢失
     def is_pressed(self):
-        state = self.pin.value()
-        if state == 0 and self.last_state == 1:
-            time.sleep_ms(self.debounce)
-            if self.pin.value() == 0:
-                self.last_state = 0
-                self.pressed_time = time.ticks_ms()
-                return True
-        elif state == 1 and self.last_state == 0:
-            self.last_state = 1
-        return False
-
-    def is_long_pressed(self):
-        state = self.pin.value()
-        if state == 0 and self.last_state == 1:
-            time.sleep_ms(self.debounce)
-            if self.pin.value() == 0:
-                self.last_state = 0
-                self.pressed_time = time.ticks_ms()
-        elif state == 0 and self.last_state == 0:
-            if time.ticks_diff(time.ticks_ms(), self.pressed_time) > self.long_press_threshold:
-                self.last_state = 1  # 避免重复触发
-                return True
-        elif state == 1 and self.last_state == 0:
-            self.last_state = 1
-        return False
+        irq_state = machine.disable_irq()
+        pending = self._pending_press
+        self._pending_press = False
+        machine.enable_irq(irq_state)
+        return pending
+
+    # 丢弃尚未读取的按下
+    def clear(self):
+        irq_state = machine.disable_irq()
+        self._pending_press = False
+        machine.enable_irq(irq_state)
+
+    # 是否已持续按住至少ms毫秒（只读状态，不消耗按下事件，用于组合键）
+    def is_held(self, ms):
+        return self.pin.value() == 0 and time.ticks_diff(time.ticks_ms(), self.pressed_time) >= ms
 
 # 显示处理类，统一管理屏幕输出
 class Display:
+    # 清屏并把光标移到左上角，比 "\033c" 重置整个终端的开销小
     @staticmethod
     def clear():
-        print("\033c")
+        print("\033[H\033[2J", end="")
+
+    # 光标回到左上角后一次写出整屏内容，每行末尾清除旧字符，最后清除多余的旧行
+    @staticmethod
+    def render(lines):
+        sys.stdout.write("\033[H" + "\033[K\n".join(lines) + "\033[K\n\033[J")
+
+    # 只重写屏幕上的某一行（行号从1开始）
+    @staticmethod
+    def render_line(row, text):
+        sys.stdout.write(f"\033[{row};1H{text}\033[K")
 
     @staticmethod
     def show_title(text):
@@ -85,29 +117,34 @@ class Menu:
         self.options = options
         self.action_map = action_map or {}
         self.selected = 0
+        # 标题栏和提示栏不变，预先拼好
+        self._header = ["="*30, title, "="*30]
+        self._footer = ["="*30, "上: 上一项 | 下: 下一项 | 选择: 确认 | 返回: 后退"]
 
     def show(self, buttons):
+        # 按钮在循环外取出，轮询时不再查字典
+        up, down, select, back = buttons["up"], buttons["down"], buttons["select"], buttons["back"]
+        rendered = -1  # 上次绘制时的选中项，未变化时不重绘
+        Display.clear()
         while True:
-            Display.clear()
-            Display.show_title(self.title)
-
-            for i, option in enumerate(self.options):
-                prefix = "→ " if i == self.selected else "   "
-                print(f"{prefix}{option}")
-
-            print("="*30)
-            print("上: 上一项 | 下: 下一项 | 选择: 确认 | 返回: 后退")
-
-            if buttons["up"].is_pressed():
+            if self.selected != rendered:
+                rendered = self.selected
+                lines = self._header[:]
+                for i, option in enumerate(self.options):
+                    prefix = "→ " if i == self.selected else "   "
+                    lines.append(f"{prefix}{option}")
+                Display.render(lines + self._footer)
+
+            if up.is_pressed():
                 self.selected = (self.selected - 1) % len(self.options)
-            elif buttons["down"].is_pressed():
+            elif down.is_pressed():
                 self.selected = (self.selected + 1) % len(self.options)
-            elif buttons["select"].is_pressed():
+            elif select.is_pressed():
                 if self.selected in self.action_map:
                     return self.action_map[self.selected]()
                 else:
                     return self.selected
-            elif buttons["back"].is_pressed():
+            elif back.is_pressed():
                 return -1
 
             time.sleep_ms(Config.MENU_UPDATE_DELAY)
@@ -124,94 +161,392 @@ class ChineseInput:
         "和穆萧尹姚邵湛汪祁毛禹狄米贝明臧",
         "计伏成戴谈宋茅庞熊纪舒屈项祝董梁"
     ]
+    GRID_TOP = 6  # 字符表第一行在屏幕上的行号（标题3行，输入内容和分隔线各1行）
 
     def __init__(self, title="输入姓名", max_length=8):
         self.title = title
         self.max_length = max_length
+        self._header = ["="*30, title, "="*30]
+        self._footer = ["-"*30, "上: 上一项 | 下: 下一项 | 选择: 添加 | 返回: 删除 | 长按上+下: 确认"]
+        # 每页的字符表预先排好，每格为 " 字  "，绘制选中项时只替换其中一格
+        self._page_rows = [["".join(f" {c}  " for c in chars[i:i+4]) for i in range(0, len(chars), 4)]
+                           for chars in self.CHAR_SETS]
+
+    def _grid_line(self, page, row, selected):
+        line = self._page_rows[page][row]
+        j = selected - row * 4
+        if 0 <= j < 4:
+            k = j * 4
+            line = line[:k] + "[" + line[k+1] + "]" + line[k+3:]
+        return line
 
     def input(self, buttons):
         current_text = ""
         page = 0
         selected = 0
+        rendered = None  # 上次整屏绘制时的 (页, 输入内容)，未变化时不整屏重绘
+        drawn = selected  # 屏幕上当前标出的选中项
+        chord_fired = False  # 本次按住组合键是否已触发，松开后才能再次触发
+        up, down, select, back = buttons["up"], buttons["down"], buttons["select"], buttons["back"]
+        Display.clear()
 
         while True:
-            Display.clear()
-            Display.show_title(self.title)
-            print(f"当前输入: {current_text}")
-            print("-"*30)
-
-            if page < len(self.CHAR_SETS):
-                chars = self.CHAR_SETS[page]
-                for i in range(0, len(chars), 4):
-                    line = ""
-                    for j in range(4):
-                        if i+j < len(chars):
-                            prefix = "[" if i+j == selected else " "
-                            suffix = "]" if i+j == selected else " "
-                            line += f"{prefix}{chars[i+j]}{suffix} "
-                    print(line)
-
-            print("-"*30)
-            print("上: 上一项 | 下: 下一项 | 选择: 添加 | 返回: 删除 | 长按上+下: 确认")
-
-            if buttons["up"].is_pressed():
+            if (page, current_text) != rendered:
+                rendered = (page, current_text)
+                # 整屏内容拼好后一次写出
+                lines = self._header + [f"当前输入: {current_text}", "-"*30]
+                if page < len(self.CHAR_SETS):
+                    for row in range(len(self._page_rows[page])):
+                        lines.append(self._grid_line(page, row, selected))
+                Display.render(lines + self._footer)
+                drawn = selected
+            elif selected != drawn:
+                # 只移动了选中项：重写原选中项和新选中项所在的行
+                for row in (drawn // 4, selected // 4):
+                    Display.render_line(self.GRID_TOP + row, self._grid_line(page, row, selected))
+                drawn = selected
+
+            # 上下同时按住为组合键，先于单键判断；按住期间的按下不再当作单键
+            chord = up.is_held(0) and down.is_held(0)
+            if not chord:
+                chord_fired = False
+            if chord:
+                up.clear()
+                down.clear()
+                if not chord_fired and up.is_held(up.long_press_threshold) and \
+                        down.is_held(down.long_press_threshold):
+                    chord_fired = True
+                    if current_text:
+                        return current_text
+                    Display.show_message("姓名不能为空！")
+                    rendered = None  # 提示覆盖了输入界面，需要重绘
+            elif up.is_pressed():
                 selected = (selected - 1) % len(self.CHAR_SETS[page])
-            elif buttons["down"].is_pressed():
+            elif down.is_pressed():
                 selected = (selected + 1) % len(self.CHAR_SETS[page])
-            elif buttons["select"].is_pressed():
+            elif select.is_pressed():
                 if page < len(self.CHAR_SETS) and len(current_text) < self.max_length:
                     current_text += self.CHAR_SETS[page][selected]
-            elif buttons["back"].is_pressed():
+            elif back.is_pressed():
                 if current_text:
                     current_text = current_text[:-1]
                 else:
                     return ""  # 取消输入
-            elif buttons["up"].is_long_pressed() and buttons["down"].is_long_pressed():
-                if current_text:
-                    return current_text
-                else:
-                    Display.show_message("姓名不能为空！")
 
             time.sleep_ms(Config.MENU_UPDATE_DELAY)
 
+# int8点积（viper编译为机器码），用于只比对少量候选用户的场合，免去逐次调用ulab的开销
+# ptr8读出的是无符号字节，(x ^ 128) - 128 还原符号
+@micropython.viper
+def _dot_int8(a: ptr8, b: ptr8, n: int) -> int:
+    s = 0
+    for i in range(n):
+        s += ((a[i] ^ 128) - 128) * ((b[i] ^ 128) - 128)
+    return s
+
 # 用户管理类，处理用户数据的增删改查
 class UserManager:
-    def __init__(self, db_path):
-        self.db_path = db_path
-        self.users = self._load_db()
+    def __init__(self, log_path, feature_path, legacy_path=None):
+        self.log_path = log_path
+        self.feature_path = feature_path
+        self.legacy_path = legacy_path
+        self._garbage = 0    # 日志中已失效的记录数
+        self._users = None   # 首次访问时才加载
+        self._stamp = None   # 加载时日志文件的 (修改时间, 大小)，变化时重新加载
+        self._planes = None
+
+    @property
+    def users(self):
+        self._ensure_loaded()
+        return self._users
+
+    # 首次使用时加载数据库（每帧都会调用，这里不访问文件系统）
+    def _ensure_loaded(self):
+        if self._users is None:
+            self._load()
+
+    # 日志被其他程序修改过时重新加载；在进入各模式前调用，而不是每次访问时检查
+    def refresh(self):
+        if self._users is None or self._log_stamp() != self._stamp:
+            self._load()
+
+    def _load(self):
+        self._garbage = 0
+        self._users, compact = self._load_db(self.legacy_path)
+        if compact:
+            self.save_db()
+        self._rebuild_matrix()
+        self._stamp = self._log_stamp()
+
+    def _log_stamp(self):
+        try:
+            st = uos.stat(self.log_path)
+            return st[8], st[6]  # FAT的修改时间精度只有2秒，同时比较大小
+        except OSError:
+            return None
+
+    # 把所有用户的特征堆成一个矩阵，识别时一次矩阵乘法算出全部相似度
+    def _rebuild_matrix(self):
+        self._ids = list(self._users.keys())
+        if self._ids:
+            self._feat_matrix = np.array([self._users[user_id]["features_q8"] for user_id in self._ids],
+                                         dtype=np.int8)
+            self._scales = np.array([self._users[user_id]["scale"] for user_id in self._ids],
+                                    dtype=np.float)
+        else:
+            self._feat_matrix = None
+            self._scales = None
+        self._rebuild_buckets()
+
+    # 用户较多时按特征哈希分桶，识别时只比对候选桶中的用户
+    def _rebuild_buckets(self):
+        self._buckets = []
+        if len(self._ids) < Config.LSH_MIN_USERS:
+            return
+        self._buckets = [{} for _ in range(Config.LSH_TABLES)]
+        for user_id in self._ids:
+            for table, h in zip(self._buckets, self._hashes(self._users[user_id]["features_q8"])):
+                table.setdefault(h, []).append(user_id)
+
+    # 随机投影哈希：每个表取一组随机超平面，第i位为特征在第i个超平面上投影的符号
+    def _hashes(self, features_q8):
+        dim = len(features_q8)
+        if self._planes is None or self._planes.shape[1] != dim:
+            random.seed(Config.LSH_SEED)
+            self._planes = np.array([[1 if random.getrandbits(1) else -1 for _ in range(dim)]
+                                     for _ in range(Config.LSH_TABLES * Config.LSH_BITS)], dtype=np.int8)
+        projections = np.dot(self._planes, features_q8)
+        hashes = []
+        for t in range(Config.LSH_TABLES):
+            h = 0
+            base = t * Config.LSH_BITS
+            for i in range(Config.LSH_BITS):
+                if projections[base + i] > 0:
+                    h |= 1 << i
+            hashes.append(h)
+        return hashes
+
+    # 任一哈希表中同桶及汉明距离为1的相邻桶中的用户（去重）
+    def _candidates(self, features_q8):
+        candidates = {}
+        for table, h in zip(self._buckets, self._hashes(features_q8)):
+            for user_id in table.get(h, ()):
+                candidates[user_id] = True
+            for i in range(Config.LSH_BITS):
+                for user_id in table.get(h ^ (1 << i), ()):
+                    candidates[user_id] = True
+        return candidates
+
+    # 日志每行一条JSON记录："put"为新增或覆盖用户，"del"为删除用户
+    def _load_db(self, legacy_path):
+        # 先处理中断的重写，避免日志被删除后误把旧版数据库当作唯一数据导入
+        self._recover()
+        try:
+            users, corrupt = self._replay()
+            compact = corrupt or self._garbage > max(Config.LOG_COMPACT_MIN, len(users))
+        except OSError:
+            # 还没有日志时一次性导入旧版JSON数据库
+            users = self._read_legacy(legacy_path)
+            compact = bool(users)
+        # 特征文件整体读入一次，各用户的特征直接引用其中的片段，不逐个分配
+        data = self._read_features() if users else b""
+        for user_id in list(users.keys()):
+            user = users[user_id]
+            if "feat_offset" in user:
+                offset, length = user["feat_offset"], user["feat_len"]
+                if offset + length > len(data):
+                    print(f"用户 {user_id} 的特征缺失，已忽略")
+                    del users[user_id]
+                    compact = True
+                    continue
+                user["features_q8"] = np.frombuffer(data, dtype=np.int8, count=length, offset=offset)
+            elif "features_q8" in user:
+                # 特征直接写在记录里的旧数据，重写后移入特征文件
+                user["features_q8"] = np.array(user["features_q8"], dtype=np.int8)
+                compact = True
+            else:
+                # 旧数据是浮点特征，加载时升级为int8量化特征
+                user["features_q8"], user["scale"] = self._quantize(user.pop("features"))
+                user.pop("normalized", None)
+                compact = True
+        return users, compact
+
+    def _read_features(self):
+        try:
+            with open(self.feature_path, "rb") as f:
+                return f.read()
+        except OSError:
+            return b""
+
+    def _replay(self):
+        users = {}
+        corrupt = False
+        with open(self.log_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 写入中断导致的残缺记录，忽略并在加载后重写日志
+                    print("用户数据库日志末尾损坏，已忽略")
+                    corrupt = True
+                    break
+                user_id = record.pop("id")
+                if record.pop("op") == "del":
+                    users.pop(user_id, None)
+                    self._garbage += 2
+                else:
+                    if user_id in users:
+                        self._garbage += 1
+                    users[user_id] = record
+        return users, corrupt
 
-    def _load_db(self):
+    @staticmethod
+    def _read_legacy(legacy_path):
+        if not legacy_path:
+            return {}
         try:
-            with open(self.db_path, "r") as f:
+            with open(legacy_path, "r") as f:
                 return json.load(f)
         except Exception:
             return {}
 
+    @staticmethod
+    def _record(user_id, user):
+        # 特征保存在特征文件中，记录里只有偏移和长度
+        record = dict(user)
+        del record["features_q8"]
+        record["op"] = "put"
+        record["id"] = user_id
+        return record
+
+    # 把一条修改追加到日志末尾；失效记录过多时改为整体重写
+    def _log(self, record, garbage=0):
+        self._garbage += garbage
+        if self._garbage > max(Config.LOG_COMPACT_MIN, len(self._users)):
+            return self.save_db()
+        try:
+            with open(self.log_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            self._stamp = self._log_stamp()  # 自己写入的修改不需要重新加载
+            return True
+        except Exception as e:
+            print(f"保存数据库失败: {e}")
+            return False
+
+    # 特征追加到特征文件末尾，再在日志中追加用户记录
+    def _log_user(self, user_id, user, garbage=0):
+        features = user["features_q8"].tobytes()
+        try:
+            try:
+                offset = uos.stat(self.feature_path)[6]
+            except OSError:
+                offset = 0
+            with open(self.feature_path, "ab") as f:
+                f.write(features)
+        except Exception as e:
+            print(f"保存特征失败: {e}")
+            return False
+        user["feat_offset"] = offset
+        user["feat_len"] = len(features)
+        return self._log(self._record(user_id, user), garbage)
+
+    # 按当前用户重写日志和特征文件，先写临时文件再替换，避免写入中断损坏数据库
     def save_db(self):
         try:
-            with open(self.db_path, "w") as f:
-                json.dump(self.users, f)
+            offset = 0
+            with open(self.feature_path + ".tmp", "wb") as fb:
+                with open(self.log_path + ".new", "w") as f:
+                    for user_id, user in self._users.items():
+                        features = user["features_q8"].tobytes()
+                        fb.write(features)
+                        user["feat_offset"] = offset
+                        user["feat_len"] = len(features)
+                        offset += len(features)
+                        f.write(json.dumps(self._record(user_id, user)) + "\n")
+            # 两个新文件都写完后才生成日志临时文件，之后的替换中断时可由 _recover 补完
+            uos.rename(self.log_path + ".new", self.log_path + ".tmp")
+            self._replace(self.feature_path)
+            self._replace(self.log_path)
+            self._garbage = 0
+            self._stamp = self._log_stamp()
             return True
         except Exception as e:
             print(f"保存数据库失败: {e}")
             return False
 
+    # 重写中断后的恢复：日志临时文件只在两个新文件都写完后才出现，
+    # 它存在就补完替换（日志最后替换），否则丢弃写到一半的临时文件，旧的两个文件仍然配套
+    def _recover(self):
+        if self._exists(self.log_path + ".tmp"):
+            self._replace(self.feature_path)
+            self._replace(self.log_path)
+            print("已恢复中断的用户数据库重写")
+            return
+        for path in (self.feature_path + ".tmp", self.log_path + ".new"):
+            if self._exists(path):
+                uos.remove(path)
+
+    @staticmethod
+    def _exists(path):
+        try:
+            uos.stat(path)
+            return True
+        except OSError:
+            return False
+
+    # 用临时文件替换正式文件（临时文件不存在时说明已经替换过）
+    def _replace(self, path):
+        if not self._exists(path + ".tmp"):
+            return
+        if self._exists(path):
+            uos.remove(path)
+        uos.rename(path + ".tmp", path)
+
     def add_user(self, name, features):
+        self._ensure_loaded()
         user_id = str(time.ticks_ms())
-        self.users[user_id] = {
+        features_q8, scale = self._quantize(features)
+        self._users[user_id] = {
             "name": name,
-            "features": features,
+            "features_q8": features_q8,
+            "scale": scale,
             "registered_at": str(time.localtime()),
             "samples_count": 1
         }
-        return self.save_db(), user_id
+        self._rebuild_matrix()
+        return self._log_user(user_id, self._users[user_id]), user_id
+
+    def update_features(self, user_id, features, samples_count):
+        self._ensure_loaded()
+        user = self._users.get(user_id)
+        if not user:
+            return False
+        user["features_q8"], user["scale"] = self._quantize(features)
+        user["samples_count"] = samples_count
+        self._rebuild_matrix()
+        return self._log_user(user_id, user, 1)
+
+    def rename_user(self, user_id, name):
+        self._ensure_loaded()
+        user = self._users.get(user_id)
+        if not user:
+            return False
+        user["name"] = name
+        return self._log(self._record(user_id, user), 1)
 
     def delete_user(self, user_id):
-        if user_id in self.users:
-            del self.users[user_id]
-            return self.save_db()
+        self._ensure_loaded()
+        if user_id in self._users:
+            del self._users[user_id]
+            self._rebuild_matrix()
+            return self._log({"op": "del", "id": user_id}, 2)
         return False
 
+    def clear_users(self):
+        self._users = {}
+        self._rebuild_matrix()
+        return self.save_db()
+
     def get_user(self, user_id):
         return self.users.get(user_id)
 
@@ -219,42 +554,95 @@ class UserManager:
         return list(self.users.items())
 
     def find_user_by_features(self, features, threshold=Config.SIMILARITY_THRESHOLD):
-        if not features:
+        self._ensure_loaded()
+        if features is None or self._feat_matrix is None:
             return None
 
-        best_match = None
-        highest_similarity = threshold
-
-        for user_id, user_data in self.users.items():
-            similarity = self._cosine_similarity(features, user_data["features"])
-            if similarity > highest_similarity:
-                highest_similarity = similarity
-                best_match = user_id
-
-        return best_match
+        # 存储的是单位向量的int8量化值，整数点积乘以两边的缩放系数即为余弦相似度
+        query_q8, scale = self._quantize(features)
+
+        if self._buckets:
+            # 用户较多时先只比对候选用户，候选中有达到阈值的即可返回
+            best_match = None
+            highest_similarity = threshold
+            for user_id in self._candidates(query_q8):
+                user = self._users[user_id]
+                similarity = _dot_int8(user["features_q8"], query_q8, len(query_q8)) * user["scale"] * scale
+                if similarity > highest_similarity:
+                    highest_similarity = similarity
+                    best_match = user_id
+            if best_match is not None:
+                return best_match
+            # 哈希可能把已注册的人脸分到其他桶，候选中没有匹配时再全部比对，避免漏识
+
+        # 一次矩阵乘法比对全部用户
+        scores = np.dot(self._feat_matrix, query_q8) * self._scales * scale
+        idx = int(np.argmax(scores))
+        if scores[idx] > threshold:
+            return self._ids[idx]
+        return None
 
     @staticmethod
-    def _cosine_similarity(feat1, feat2):
-        dot_product = sum(a * b for a, b in zip(feat1, feat2))
-        norm_a = sum(a * a for a in feat1) ** 0.5
-        norm_b = sum(b * b for b in feat2) ** 0.5
-        if norm_a == 0 or norm_b == 0:
-            return 0
-        return dot_product / (norm_a * norm_b)
+    def _normalize(features):
+        features = np.array(features, dtype=np.float)
+        norm = np.linalg.norm(features)
+        if norm == 0:
+            return features
+        return features / norm
+
+    # 归一化后量化为int8，返回 (量化值, 缩放系数)，原单位向量约等于 量化值 * 缩放系数
+    @staticmethod
+    def _quantize(features):
+        features = UserManager._normalize(features)
+        peak = np.max(abs(features))
+        if peak == 0:
+            return np.zeros(len(features), dtype=np.int8), 0.0
+        scale = float(peak) / 127
+        return np.array(np.around(features / scale), dtype=np.int8), scale
 
 # 人脸检测器类
 class FaceDetector:
-    def __init__(self, cascade_model, face_model, landmark_model):
+    def __init__(self, cascade_model, face_model):
         self.cascade_model = cascade_model
         self.face_model = face_model
-        self.landmark_model = landmark_model
+        # 级联分类器只加载一次，每帧复用
+        self._face_cascade = image.HaarCascade(cascade_model)
+        self._eye_cascade = image.HaarCascade(Config.EYE_CASCADE_MODEL)
+        # 识别模型只加载一次；模型输入缓冲区预先分配，每次提取特征时复用
+        self._face_net = tf.load(face_model) if face_model else None
+        self._face_buf = image.Image(Config.FACE_INPUT_SIZE, Config.FACE_INPUT_SIZE, sensor.RGB565)
 
     def detect_faces(self, img):
-        return img.find_features(image.HaarCascade(self.cascade_model), threshold=0.75, scale_factor=1.25)
+        # 在缩小的灰度图上检测，再把人脸框坐标还原到原图；原图保持彩色用于显示和特征提取
+        s = Config.DETECT_SCALE
+        small = img.mean_pooled(s, s).to_grayscale()
+        faces = small.find_features(self._face_cascade, threshold=0.75, scale_factor=1.25)
+        return [(x * s, y * s, w * s, h * s) for x, y, w, h in faces]
+
+    @staticmethod
+    def largest_face(faces):
+        best = faces[0]
+        best_area = best[2] * best[3]
+        for face in faces:
+            area = face[2] * face[3]
+            if area > best_area:
+                best, best_area = face, area
+        return best
+
+    def detect_eyes(self, img, face):
+        # 眼睛只在人脸上半部分，去掉额头后只检测这一段
+        roi = (face[0], face[1] + face[3] // 6, face[2], face[3] // 2)
+        return img.find_features(self._eye_cascade, threshold=0.75, scale_factor=1.25, roi=roi)
 
     def extract_features(self, img, face):
-        # 这里需要根据具体模型实现特征提取
-        pass
+        if not self._face_net:
+            return None
+        # 裁剪和缩放一次完成，直接画入预分配的缓冲区，不分配新图像
+        size = Config.FACE_INPUT_SIZE
+        self._face_buf.draw_image(img, 0, 0, x_scale=size / face[2], y_scale=size / face[3], roi=face)
+        return self._face_net.classify(
+            self._face_buf, min_scale=1.0, scale_mul=0.8, x_overlap=0.5, y_overlap=0.5
+        )[0].output()
 
 # 人脸识别应用主类
 class FaceRecognitionApp:
@@ -272,11 +660,10 @@ class FaceRecognitionApp:
 
         self.face_detector = FaceDetector(
             Config.CASCADE_MODEL,
-            Config.FACE_MODEL,
-            Config.LANDMARK_MODEL
+            Config.FACE_MODEL
         )
 
-        self.user_manager = UserManager(Config.DB_PATH)
+        self.user_manager = UserManager(Config.USER_LOG_PATH, Config.FEATURE_PATH, Config.DB_PATH)
 
     def _init_hardware(self):
         sensor.reset()
@@ -303,29 +690,54 @@ class FaceRecognitionApp:
         })
 
         while True:
+            self.user_manager.refresh()
             main_menu.show(self.buttons)
 
     def _recognition_mode(self):
         Display.show_message("开始人脸识别，按返回键退出")
+        self._last_faces = []  # 上一帧的 (人脸框, 名称, 颜色, 剩余沿用帧数)
 
         while True:
             img = sensor.snapshot()
             faces = self.face_detector.detect_faces(img)
 
-            if faces:
-                for face in faces:
+            tracked = []
+            for face in faces:
+                last = self._find_last_face(face)
+                if last:
+                    # 人脸基本没动，沿用上一帧的结果，跳过特征提取和比对
+                    _, label, color, ttl = last
+                    ttl -= 1
+                else:
                     features = self.face_detector.extract_features(img, face)
                     user_id = self.user_manager.find_user_by_features(features)
-
                     if user_id:
-                        user = self.user_manager.get_user(user_id)
-                        Display.draw_face_info(img, face, user["name"], (0, 255, 0))
+                        label, color = self.user_manager.get_user(user_id)["name"], (0, 255, 0)
                     else:
-                        Display.draw_face_info(img, face, "未知人脸", (255, 0, 0))
+                        label, color = "未知人脸", (255, 0, 0)
+                    ttl = Config.TRACK_TTL
+                tracked.append((face, label, color, ttl))
+                Display.draw_face_info(img, face, label, color)
+            self._last_faces = tracked
 
             if self.buttons["back"].is_pressed():
                 break
 
+    def _find_last_face(self, face):
+        for last in self._last_faces:
+            if last[3] > 0 and self._iou(last[0], face) >= Config.TRACK_IOU:
+                return last
+        return None
+
+    @staticmethod
+    def _iou(a, b):
+        w = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+        h = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+        if w <= 0 or h <= 0:
+            return 0
+        inter = w * h
+        return inter / (a[2] * a[3] + b[2] * b[3] - inter)
+
     def _registration_mode(self):
         Display.show_message("进入人脸注册模式")
 
@@ -345,7 +757,7 @@ class FaceRecognitionApp:
             faces = self.face_detector.detect_faces(img)
 
             if faces:
-                face = max(faces, key=lambda f: f[2] * f[3])  # 选择最大的人脸
+                face = self.face_detector.largest_face(faces)  # 选择最大的人脸
                 img.draw_rectangle(face)
                 img.draw_string(face[0], face[1]-10,
                                f"样本 {len(samples)+1}/{Config.REGISTRATION_SAMPLES}")
@@ -376,7 +788,7 @@ class FaceRecognitionApp:
             return
 
         # 计算平均特征
-        avg_features = [sum(f[i] for f in samples) / len(samples) for i in range(len(samples[0]))]
+        avg_features = np.mean(np.array(samples, dtype=np.float), axis=0)
 
         # 保存用户
         success, user_id = self.user_manager.add_user(name, avg_features)
@@ -390,21 +802,33 @@ class FaceRecognitionApp:
         start_time = time.ticks_ms()
         eyes_detected = False
         eyes_closed = False
+        # 人脸位置只在开始时检测，之后每帧只在该位置检测眼睛
+        face = None
+        detected_at = start_time
 
         while time.ticks_diff(time.ticks_ms(), start_time) < Config.LIVENESS_TIMEOUT:
             img = sensor.snapshot()
-            faces = self.face_detector.detect_faces(img)
+            if face is None or (not eyes_detected and
+                                time.ticks_diff(time.ticks_ms(), detected_at) > Config.LIVENESS_REDETECT):
+                faces = self.face_detector.detect_faces(img)
+                face = self.face_detector.largest_face(faces) if faces else None
+                detected_at = time.ticks_ms()
 
-            if faces:
-                face = faces[0]
-                eyes = img.find_features(image.HaarCascade("eye"), threshold=0.75,
-                                        scale_factor=1.25, roi=face)
+            if face:
+                eyes = self.face_detector.detect_eyes(img, face)
 
                 if eyes and not eyes_detected:
                     eyes_detected = True
                 elif eyes_detected and not eyes:
-                    eyes_closed = True
-                    break
+                    # 确认人脸仍在原处，避免把人脸移开或平移误判为眨眼
+                    faces = self.face_detector.detect_faces(img)
+                    moved = self.face_detector.largest_face(faces) if faces else None
+                    if moved and self._iou(moved, face) >= Config.TRACK_IOU:
+                        eyes_closed = True
+                        break
+                    # 人脸已移动：在新位置继续等待眨眼
+                    face = moved
+                    detected_at = time.ticks_ms()
 
             if self.buttons["back"].is_pressed():
                 break
@@ -467,8 +891,7 @@ class FaceRecognitionApp:
         print("="*30)
         print("按任意键返回")
 
-        while not any(btn.is_pressed() for btn in self.buttons.values()):
-            time.sleep_ms(100)
+        self._wait_any_button()
 
     def _rename_user(self, user_id):
         user = self.user_manager.get_user(user_id)
@@ -480,8 +903,7 @@ class FaceRecognitionApp:
         new_name = inputer.input(self.buttons)
 
         if new_name and new_name != user['name']:
-            user['name'] = new_name
-            if self.user_manager.save_db():
+            if self.user_manager.rename_user(user_id, new_name):
                 Display.show_message(f"已重命名为: {new_name}")
             else:
                 Display.show_message("保存失败")
@@ -500,7 +922,7 @@ class FaceRecognitionApp:
             faces = self.face_detector.detect_faces(img)
 
             if faces:
-                face = max(faces, key=lambda f: f[2] * f[3])
+                face = self.face_detector.largest_face(faces)
                 img.draw_rectangle(face)
                 img.draw_string(face[0], face[1]-10,
                                f"样本 {len(samples)+1}/{Config.REGISTRATION_SAMPLES}")
@@ -524,11 +946,9 @@ class FaceRecognitionApp:
             Display.show_message("采集失败：未获取到有效样本")
             return
 
-        avg_features = [sum(f[i] for f in samples) / len(samples) for i in range(len(samples[0]))]
-        user['features'] = avg_features
-        user['samples_count'] = len(samples)
+        avg_features = np.mean(np.array(samples, dtype=np.float), axis=0)
 
-        if self.user_manager.save_db():
+        if self.user_manager.update_features(user_id, avg_features, len(samples)):
             Display.show_message("人脸特征已更新")
         else:
             Display.show_message("保存失败")
@@ -564,6 +984,8 @@ class FaceRecognitionApp:
 
     def _adjust_threshold(self):
         current_threshold = Config.SIMILARITY_THRESHOLD
+        buttons = self.buttons
+        up, down, select, back = buttons["up"], buttons["down"], buttons["select"], buttons["back"]
         while True:
             Display.clear()
             Display.show_title("调整识别阈值")
@@ -572,15 +994,15 @@ class FaceRecognitionApp:
             print("上: 增加 0.1 | 下: 减少 0.1")
             print("选择: 确认 | 返回: 取消")
 
-            if self.buttons["up"].is_pressed():
+            if up.is_pressed():
                 current_threshold = min(1.0, current_threshold + 0.1)
-            elif self.buttons["down"].is_pressed():
+            elif down.is_pressed():
                 current_threshold = max(0.1, current_threshold - 0.1)
-            elif self.buttons["select"].is_pressed():
+            elif select.is_pressed():
                 Config.SIMILARITY_THRESHOLD = current_threshold
                 Display.show_message(f"已设置识别阈值为: {current_threshold:.1f}")
                 break
-            elif self.buttons["back"].is_pressed():
+            elif back.is_pressed():
                 break
 
             time.sleep_ms(Config.MENU_UPDATE_DELAY)
@@ -598,8 +1020,7 @@ class FaceRecognitionApp:
         choice = confirm_menu.show(self.buttons)
 
         if choice == 0:
-            self.user_manager.users = {}
-            if self.user_manager.save_db():
+            if self.user_manager.clear_users():
                 Display.show_message("数据库已重置")
             else:
                 Display.show_message("重置失败")
@@ -612,7 +1033,14 @@ class FaceRecognitionApp:
         print("="*30)
         print("按任意键返回")
 
-        while not any(btn.is_pressed() for btn in self.buttons.values()):
+        self._wait_any_button()
+
+    def _wait_any_button(self):
+        buttons = tuple(self.buttons.values())
+        while True:
+            for btn in buttons:
+                if btn.is_pressed():
+                    return
             time.sleep_ms(100)
 
     def _exit_system(self):